@@ -22,10 +22,65 @@
 #       MA 02110-1301, USA.
 
 """
-Usage: sfm [-v] [-q] [-u username [-p password [-a account]]]
-        store|retrieve|remove|info hostname[:port] [remotedir [localdir]]
+Usage: sfm [-v] [-q] [-j jobs] [-w scanners] [-s segments [-S size]] [-B size] [-L lister]
+        [-b backend] [-m manifest] [-D mode] [-C ttl [-P]] [-i [-F days]] [-c algorithm]
+        [-r schedule] [-R retries] [-I pattern] [-X pattern] [--min-size size]
+        [--max-size size] [--newer-than age] [--older-than age] [--plan file] [--resume]
+        [--events file] [--metrics port]
+        [-u username [-p password [-a account]]]
+        store|retrieve|remove|info [transport://]hostname[:port] [remotedir [localdir]]
 -v: verbose (-vvv debug)
 -q: quiet
+-j jobs: number of parallel transfer connections (default 1)
+-w scanners: number of parallel listing connections (default 1)
+-s segments: download large files in N parallel segments (default 1)
+-S size: minimum file size for segmented downloads (default 100M)
+-B size: transfer block size (default 1M)
+-L lister: remote listing strategy, auto|mlsd|list (default auto)
+-b backend: FTP client, ftplib (blocking, one socket set per thread)
+    or asyncio (default ftplib); with asyncio the -j transfers and their
+    -s segments are coroutines on one event loop thread instead of a
+    thread each, listings and removals still use their threads
+-m manifest: sync state database (default ~/.sfmstat.db)
+-D mode: how pruned files and directories are removed, delete (bulk
+    delete), rename (renamed to name.sfm-deleted right away, deleted at
+    the end of the run)
+    or trash:/path (moved to their relative path below a directory per
+    run in /path, outside the mirror); kept per mirror once given
+    (default delete)
+-C ttl: reuse remote directory listings for ttl seconds, listings of
+    directories changed by this tool are dropped right away
+-P: with -C, keep the listing cache in the manifest between runs
+-i: incremental, skip directories whose mtime is unchanged since the
+    last run and that exist in the target; their subdirectories are
+    still listed, as changes further down do not touch the mtime
+-F days: with -i, run a full verify pass every N days (default 7)
+-c algorithm: verify content with md5|sha1|sha256|crc32 checksums
+-r schedule: bandwidth limit shared by all connections, either a rate
+    (e.g. 20M) or time windows with an optional default rate
+    (e.g. 08:00-18:00=20M,2M), unlimited outside the schedule;
+    @file reads the schedule from file and picks up changes to it
+    during the run (e.g. from mirror-jobs.py)
+-R retries: attempts per operation after a transient error, with
+    exponential backoff (default 3)
+-I pattern: only mirror files matching pattern, may be repeated
+-X pattern: skip files and directories matching pattern, may be repeated;
+    patterns are globs matched against the name, or the path below the
+    mirror root when they contain a /, re:regex matches the path, a
+    trailing / only matches directories. Excluded directories are not
+    listed and filtered entries in the target are left alone
+--min-size size: skip source files smaller than size
+--max-size size: skip source files larger than size
+--newer-than age: skip source files older than age, in days or as
+    YYYY-MM-DD
+--older-than age: skip source files newer than age
+--plan file: compare only and write the planned actions to file
+    (JSON if the name ends with .json, TSV otherwise)
+--resume: continue an interrupted store or retrieve where it stopped
+--events file: append JSON lines events (transfers, retries, failures
+    and progress every 10s with throughput and ETA) to file
+--metrics port: serve live counters and per connection LIST/RETR/STOR
+    latencies on http://127.0.0.1:port/metrics (Prometheus format)
 -u username: ftp username (default anonymous)
 -p password: ftp password
 -a account: ftp account
@@ -33,6 +88,10 @@ store: mirror the content of localdir to remotedir
 retrieve: mirror the content of remotedir to localdir
 remove: remove remotedir recursively
 info: prints some information about remote mirror
+transport: ftp (default), ftps (explicit TLS, the server certificate
+    must verify), sftp (needs paramiko, the host key must be in
+    ~/.ssh/known_hosts), http or https (directory indexes, retrieve
+    only) or file (local directories, use file:// without a hostname)
 hostname[:port]: remote host
 remotedir: remote directory (default initial)
 localdir: local directory (default current)
@@ -43,68 +102,2684 @@ Example: sfm -u myuser store ftp.mydomain.com /myfolder /my/folder
 
 import sys
 import os
+import asyncio
 import getopt
 import getpass
+import hashlib
+import json
 import ftplib
+import http.client
+import http.server
+import email.utils
+import errno
+import fnmatch
+import urllib.parse
+import re
+import socket
+import ssl
+import stat as statlib
+import sqlite3
 import time
+import calendar
 import datetime
-from io import StringIO
+import itertools
+import threading
+import queue
+import collections
+import zlib
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
 
 globals = {
     'verbose': 1,
+    'jobs': 1,
+    'scanners': 1,
+    'queue_size': 10000,
+    'segments': 1,
+    'segment_size': 100 * 1024 ** 2,
+    'blocksize': 1024 ** 2,
+    'lister': 'auto',
+    'backend': 'ftplib',
+    'manifest': os.path.expanduser('~/.sfmstat.db'),
+    'incremental': False,
+    'verify_interval': 7 * 86400,
+    'plan': None,
+    'resume': False,
+    'deletion': None,
+    'cache_ttl': 0,
+    'cache_persist': False,
+    'cache': None,
+    'filters': None,
+    'events': None,
+    'metrics_port': None,
+    'metrics': None,
+    'checksum': None,
+    'limiter': None,
+    'removers': None,
+    'retries': 3,
+    'backoff': 2,
+    'failures': [],
+    'lock': threading.Lock(),
+    'output': threading.Lock(),
     'status': {
         'dirs_total': 0,
         'dirs_created': 0,
         'dirs_removed': 0,
+        'dirs_skipped': 0,
+        'dirs_excluded': 0,
         'files_total': 0,
         'files_created': 0,
         'files_updated': 0,
         'files_removed': 0,
+        'files_excluded': 0,
         'bytes_transfered': 0,
         'bytes_total': 0,
+        'bytes_excluded': 0,
+        'seconds_throttled': 0.0,
+        'retries': 0,
         'time_started': datetime.datetime.now(),
         'time_finished': 0,
     },
 }
 
 
-def log(msg, level=1, abort=False):
-    if level <= globals['verbose'] or abort:
-        if abort:
-            sys.stdout = sys.stderr
-            print()
-        print(msg)
-    if abort:
-        sys.exit(1)
+def log(msg, level=1, abort=False):
+    if level <= globals['verbose'] or abort:
+        if abort:
+            sys.stdout = sys.stderr
+            print()
+        with globals['output']:
+            print(msg)
+    if abort:
+        sys.exit(1)
+
+
+def count(key, value=1):
+    with globals['lock']:
+        globals['status'][key] += value
+
+
+def strfbytes(value):
+    global unit
+    units = ['Bytes', 'KB', 'MB', 'GB', 'TB']
+    value = float(value)
+    for unit in units:
+        if value < 1024: break
+        value /= 1024
+    if unit == units[0]:
+        fmt = '%.0f %s'
+    else:
+        fmt = '%.2f %s'
+    return fmt % (value, unit)
+
+
+def strftime(mtime):
+    return mtime and datetime.datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M') or '-'
+
+
+def strtobytes(value):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def listinghash(dirs, files):
+    digest = hashlib.sha1()
+    for name in sorted(dirs):
+        digest.update(('%s/\t%i\n' % (name, dirs[name]['mtime'])).encode('utf-8'))
+    for name in sorted(files):
+        digest.update(('%s\t%i\t%i\n' % (name, files[name]['size'], files[name]['mtime'])).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class crc32:
+    """hashlib style wrapper around zlib.crc32"""
+
+    name = 'crc32'
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return '%08x' % self.value
+
+
+def newdigest():
+    if globals['checksum'] == 'crc32':
+        return crc32()
+    return hashlib.new(globals['checksum'])
+
+
+def hashfile(digest, path, length=None):
+    fh = open(path, 'rb')
+    while length is None or length > 0:
+        data = fh.read(globals['blocksize'] if length is None else min(length, globals['blocksize']))
+        if not data:
+            break
+        digest.update(data)
+        if length is not None:
+            length -= len(data)
+    fh.close()
+    return digest
+
+
+class rateLimiter:
+    """Token bucket bandwidth limit following a time-of-day schedule. The
+    current rate is split evenly between the connections that are active"""
+
+    def __init__(self, schedule):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.seen = {}
+        self.path = None
+        if schedule.startswith('@'):
+            # Schedule kept in a file another process may rewrite during the run
+            self.path = schedule[1:]
+            self.checked = time.time()
+            self.modified = self.mtime()
+            schedule = self.read()
+        self.parse(schedule)
+
+    def parse(self, schedule):
+        rules = []
+        default = 0
+        for rule in schedule.split(','):
+            window, _, rate = rule.strip().rpartition('=')
+            if window:
+                start, end = [int(t[:2]) * 60 + int(t[3:]) for t in window.split('-')]
+                rules.append((start, end, strtobytes(rate)))
+            else:
+                default = strtobytes(rate)
+        self.schedule, self.default = rules, default
+
+    def mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def read(self):
+        try:
+            with open(self.path) as fh:
+                return fh.read().strip() or '0'
+        except OSError as err:
+            raise ValueError(err)
+
+    def reload(self):
+        """Picks up a rewritten schedule file, looking at most once a second.
+        A file that went away or does not parse keeps the last schedule"""
+        now = time.time()
+        with self.lock:
+            if now - self.checked < 1.0:
+                return
+            self.checked = now
+            modified = self.mtime()
+            if modified is None or modified == self.modified:
+                return
+            self.modified = modified
+            try:
+                self.parse(self.read())
+            except ValueError as err:
+                log('Keeping the rate schedule, %s could not be read: %s' % (self.path, err), 2)
+                return
+        log('Rate schedule reloaded from %s' % self.path, 3)
+
+    def rate(self):
+        if self.path is not None:
+            self.reload()
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self.schedule:
+            if start <= minute < end or (end < start and (minute >= start or minute < end)):
+                return rate
+        return self.default
+
+    def delay(self, size, worker):
+        """Seconds the connection of worker has to wait after moving size bytes"""
+        rate = self.rate()
+        if not rate:
+            return 0
+        now = time.time()
+        with self.lock:
+            self.seen[worker] = now
+            active = len([seen for seen in self.seen.values() if now - seen < 1.0])
+            share = float(rate) / active
+            # Each connection keeps its own bucket holding at most one second of its share
+            tokens, updated = self.buckets.get(worker, (share, now))
+            tokens = min(share, tokens + (now - updated) * share) - size
+            self.buckets[worker] = (tokens, now)
+        if tokens >= 0:
+            return 0
+        count('seconds_throttled', -tokens / share)
+        return -tokens / share
+
+    def throttle(self, size):
+        delay = self.delay(size, threading.current_thread().name)
+        if delay:
+            time.sleep(delay)
+
+
+def throttle(size):
+    if globals['limiter'] is not None:
+        globals['limiter'].throttle(size)
+
+
+def receive(conn, fh, digest=None, length=None):
+    """Copy a data connection into fh through one reusable buffer, hashing
+    and rate limiting on the way. Returns the number of bytes missing when
+    length is given"""
+    buffer = memoryview(bytearray(globals['blocksize']))
+    while length is None or length > 0:
+        view = buffer if length is None else buffer[:min(length, len(buffer))]
+        size = conn.recv_into(view)
+        if not size:
+            break
+        fh.write(view[:size])
+        if digest is not None:
+            digest.update(view[:size])
+        throttle(size)
+        progress(size)
+        if length is not None:
+            length -= size
+    return length or 0
+
+
+def send(conn, fh, digest=None, offset=0):
+    """Copy fh from offset into a data connection. Without hashing and
+    rate limiting the kernel does the copy with sendfile"""
+    if digest is None and globals['limiter'] is None:
+        conn.sendfile(fh, offset)
+        progress(os.fstat(fh.fileno()).st_size - offset)
+        return
+    fh.seek(offset)
+    buffer = memoryview(bytearray(globals['blocksize']))
+    while True:
+        size = fh.readinto(buffer)
+        if not size:
+            break
+        if digest is not None:
+            digest.update(buffer[:size])
+        throttle(size)
+        conn.sendall(buffer[:size])
+        progress(size)
+
+
+def transient(err):
+    """Whether err is worth a new connection and another attempt. Local file
+    errors (EPERM, ENOSPC, a missing source...) are not"""
+    if isinstance(err, (ftplib.error_temp, ftplib.error_reply, ftplib.error_proto, EOFError,
+                        ConnectionError, TimeoutError, ssl.SSLError, socket.gaierror,
+                        http.client.HTTPException)):
+        return True
+    return isinstance(err, OSError) and err.errno in (errno.ENETDOWN, errno.ENETUNREACH, errno.ENETRESET,
+                                                      errno.EHOSTDOWN, errno.EHOSTUNREACH)
+
+
+def backoff(description, err, attempt):
+    """Report the retry after a transient error and return the seconds to
+    wait before it"""
+    delay = globals['backoff'] * 2 ** attempt
+    log('--> %s failed: %s, retry %i/%i in %is'
+        % (description, err or type(err).__name__, attempt + 1, globals['retries'], delay))
+    count('retries')
+    event('retry', operation=description, error=str(err or type(err).__name__), attempt=attempt + 1)
+    return delay
+
+
+def retry(pool, description, func, *args):
+    """Run func, retrying transient FTP and network errors on a fresh
+    connection. Permanent (5xx) replies and local errors are raised right
+    away"""
+    attempt = 0
+    while True:
+        try:
+            return func(*args)
+        except ftplib.error_perm:
+            raise
+        except ftplib.all_errors as err:
+            if attempt >= globals['retries'] or not transient(err):
+                raise
+            delay = backoff(description, err, attempt)
+            attempt += 1
+            if pool is not None:
+                pool.discard()
+            time.sleep(delay)
+
+
+async def aretry(description, func, discard):
+    """retry() for coroutines, discard drops the sessions func used"""
+    attempt = 0
+    while True:
+        try:
+            return await func()
+        except ftplib.error_perm:
+            raise
+        except ftplib.all_errors as err:
+            if attempt >= globals['retries'] or not transient(err):
+                raise
+            delay = backoff(description, err, attempt)
+            attempt += 1
+            discard()
+            await asyncio.sleep(delay)
+
+
+def checkdigest(name, digest, expected):
+    """The manifest form of the digest of a finished transfer, an error
+    when the digest the server computed differs"""
+    if digest is None:
+        return None
+    digest = '%s:%s' % (globals['checksum'], digest.hexdigest())
+    if expected is not None and expected != digest:
+        raise ftplib.error_proto('Checksum mismatch on %s, partial file kept' % name)
+    return digest
+
+
+def fail(description, err):
+    log('-> %s failed: %s' % (description, err))
+    event('failure', operation=description, error=str(err))
+    with globals['lock']:
+        globals['failures'].append((description, str(err)))
+
+
+def partial(name):
+    return name.endswith('.part') or name.endswith('.part.seg')
+
+
+def features(ftp):
+    try:
+        resp = ftp.sendcmd('FEAT')
+    except (ftplib.error_temp, ftplib.error_perm):
+        return {}
+    feats = {}
+    for line in resp.splitlines()[1:-1]:
+        name, _, value = line.strip().partition(' ')
+        feats[name.upper()] = value
+    return feats
+
+
+class runMetrics:
+    """Live counters of a run: transfers queued and done, throughput, ETA
+    and the latency of each operation per connection. Written as JSON lines
+    events and served in the Prometheus text format"""
+
+    def __init__(self, events=None, port=None, interval=10):
+        self.lock = threading.Lock()
+        self.queued = {'files': 0, 'bytes': 0}
+        self.done = {'files': 0, 'bytes': 0}
+        # Bytes that went over the wire, partial files included
+        self.moved = 0
+        # (operation, connection): [count, seconds, slowest]
+        self.operations = {}
+        self.samples = collections.deque([(time.time(), 0)], 7)
+        self.events = events and open(events, 'a')
+        self.server = None
+        if port:
+            self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), metricsHandler)
+            self.server.metrics = self
+            threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True).start()
+        self.stopped = threading.Event()
+        self.ticker = threading.Thread(target=self.tick, args=(interval,), name='ticker', daemon=True)
+        self.ticker.start()
+
+    def queue(self, size):
+        with self.lock:
+            self.queued['files'] += 1
+            self.queued['bytes'] += size
+
+    def move(self, size):
+        with self.lock:
+            self.moved += size
+
+    def observe(self, operation, seconds, size=None, connection=None):
+        connection = connection or threading.current_thread().name
+        with self.lock:
+            stats = self.operations.setdefault((operation, connection), [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            if size is not None:
+                self.done['files'] += 1
+                self.done['bytes'] += size
+
+    def event(self, kind, **fields):
+        if self.events is None:
+            return
+        fields['event'] = kind
+        fields['time'] = time.time()
+        line = json.dumps(fields, sort_keys=True)
+        with self.lock:
+            self.events.write(line + '\n')
+            self.events.flush()
+
+    def tick(self, interval):
+        while not self.stopped.wait(interval):
+            with self.lock:
+                self.samples.append((time.time(), self.moved))
+            self.event('progress', **self.snapshot())
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            started, first = self.samples[0]
+            snapshot = {
+                'files_queued': self.queued['files'],
+                'bytes_queued': self.queued['bytes'],
+                'files_done': self.done['files'],
+                'bytes_done': self.done['bytes'],
+                'bytes_moved': self.moved,
+            }
+        # Throughput over the last minute, the ETA assumes it holds
+        rate = now > started and (snapshot['bytes_moved'] - first) / (now - started) or 0.0
+        remaining = max(0, snapshot['bytes_queued'] - snapshot['bytes_moved'])
+        snapshot['throughput'] = rate
+        snapshot['eta_seconds'] = rate and remaining / rate or None
+        snapshot['retries'] = globals['status']['retries']
+        snapshot['failures'] = len(globals['failures'])
+        return snapshot
+
+    def prometheus(self):
+        lines = []
+        snapshot = self.snapshot()
+        for key, value in sorted(snapshot.items()):
+            if value is not None:
+                lines.append('sfm_%s %s' % (key, value))
+        for key, value in sorted(globals['status'].items()):
+            if key not in snapshot and not key.startswith('time_'):
+                lines.append('sfm_%s %s' % (key, value))
+        with self.lock:
+            operations = [('{operation="%s",connection="%s"}' % key, stats)
+                          for key, stats in sorted(self.operations.items())]
+        lines.append('# TYPE sfm_operation_seconds summary')
+        for labels, (calls, seconds, slowest) in operations:
+            lines.append('sfm_operation_seconds_count%s %i' % (labels, calls))
+            lines.append('sfm_operation_seconds_sum%s %f' % (labels, seconds))
+        # A summary has no _max series, the slowest call is a gauge of its own
+        lines.append('# TYPE sfm_operation_seconds_max gauge')
+        for labels, (calls, seconds, slowest) in operations:
+            lines.append('sfm_operation_seconds_max%s %f' % (labels, slowest))
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        self.stopped.set()
+        self.ticker.join()
+        self.event('finish', **self.snapshot())
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.events is not None:
+            self.events.close()
+            self.events = None
+
+
+class metricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves /metrics of the runMetrics attached to the server"""
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def observe(operation, seconds, size=None, connection=None):
+    if globals['metrics'] is not None:
+        globals['metrics'].observe(operation, seconds, size, connection)
+
+
+def progress(size):
+    if globals['metrics'] is not None:
+        globals['metrics'].move(size)
+
+
+def event(kind, **fields):
+    if globals['metrics'] is not None:
+        globals['metrics'].event(kind, **fields)
+
+
+class listingCache:
+    """Directory listings by host and path, valid for ttl seconds and
+    dropped as soon as this tool changes the directory. With a manifest
+    they are kept in its database between runs"""
+
+    def __init__(self, ttl, manifest=None):
+        self.ttl = ttl
+        self.manifest = manifest
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, host, path, skip_mtime=False):
+        with self.lock:
+            entry = self.entries.get((host, path))
+        if entry is None and self.manifest is not None:
+            entry = self.manifest.listing(host, path)
+            if entry is not None:
+                with self.lock:
+                    self.entries[(host, path)] = entry
+        fetched, mtimes, dirs, files = entry or (0, False, None, None)
+        # A listing taken without timestamps only serves the same kind
+        if time.time() - fetched > self.ttl or not (mtimes or skip_mtime):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        # Callers change their listings, so they get copies
+        keep = not skip_mtime
+        dirs = dict((name, {'mtime': keep and dirs[name]['mtime'] or 0}) for name in dirs)
+        files = dict((name, {'size': files[name]['size'], 'mtime': keep and files[name]['mtime'] or 0})
+                     for name in files)
+        return dirs, files
+
+    def put(self, host, path, skip_mtime, listing):
+        dirs, files = listing
+        entry = (time.time(), not skip_mtime,
+                 dict((name, dict(dirs[name])) for name in dirs),
+                 dict((name, dict(files[name])) for name in files))
+        with self.lock:
+            self.entries[(host, path)] = entry
+        if self.manifest is not None:
+            self.manifest.storelisting(host, path, entry)
+
+    def invalidate(self, host, path):
+        """Forget path and the listing of its parent directory"""
+        paths = (path.rstrip('/') or '/', os.path.dirname(path.rstrip('/')) or '/')
+        with self.lock:
+            for path in paths:
+                self.entries.pop((host, path), None)
+        if self.manifest is not None:
+            self.manifest.droplistings(host, paths)
+
+
+class filterRules:
+    """Include/exclude patterns and size/age limits, compiled once and
+    applied to each listing before its subdirectories are scanned
+
+    Patterns are globs, or regular expressions when prefixed with re:.
+    A glob with a / matches the path below the mirror root, otherwise
+    the name, and one ending with / only matches directories. Includes
+    only select files, excluded directories are never listed."""
+
+    def __init__(self):
+        self.includes = []
+        self.excludes = []
+        self.min_size = 0
+        self.max_size = None
+        self.newer = None
+        self.older = None
+
+    def compile(self, pattern):
+        if pattern.startswith('re:'):
+            return re.compile(pattern[3:]).search, True, False
+        dirs_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        return re.compile(fnmatch.translate(pattern.lstrip('/'))).match, '/' in pattern, dirs_only
+
+    def include(self, pattern):
+        self.includes.append(self.compile(pattern))
+
+    def exclude(self, pattern):
+        self.excludes.append(self.compile(pattern))
+
+    def matches(self, rules, path, name, is_dir):
+        for match, on_path, dirs_only in rules:
+            if (is_dir or not dirs_only) and match(on_path and path or name):
+                return True
+        return False
+
+    def excluded(self, path, name, is_dir):
+        if self.matches(self.excludes, path, name, is_dir):
+            return True
+        return not is_dir and self.includes and not self.matches(self.includes, path, name, False)
+
+    def limited(self, file):
+        if file['size'] < self.min_size or self.max_size is not None and file['size'] > self.max_size:
+            return True
+        if file['mtime'] and self.newer is not None and file['mtime'] < self.newer:
+            return True
+        return bool(file['mtime'] and self.older is not None and file['mtime'] > self.older)
+
+    def apply(self, subdir, dirs, files, limits=True):
+        """Drop the filtered entries of a listing and return them as
+        (name, size, is_dir) tuples, sizes and ages only count with limits"""
+        excluded = []
+        for name in list(dirs):
+            if self.excluded(os.path.join(subdir, name), name, True):
+                excluded.append((name, 0, True))
+                del dirs[name]
+        for name in list(files):
+            if not limits and partial(name):
+                continue
+            if self.excluded(os.path.join(subdir, name), name, False) or limits and self.limited(files[name]):
+                excluded.append((name, files[name]['size'], False))
+                del files[name]
+        return excluded
+
+
+def age(value):
+    """Timestamp of an age given in days or as a date (YYYY-MM-DD)"""
+    try:
+        return time.time() - float(value) * 86400
+    except ValueError:
+        return time.mktime(time.strptime(value, '%Y-%m-%d'))
+
+
+class connectionPool:
+    """Logged-in FTP connections, one session per thread"""
+
+    # Names used by the HASH command for the -c algorithms
+    hash_names = {'md5': 'MD5', 'sha1': 'SHA-1', 'sha256': 'SHA-256', 'crc32': 'CRC32'}
+
+    def __init__(self, host, port, username, password, account):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.account = account
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+        self.feats = None
+        self.cwd = None
+
+    def connect(self):
+        ftp = ftplib.FTP(timeout=300)
+        if globals['verbose'] > 2:
+            ftp.set_debuglevel(globals['verbose'] - 2)
+        ftp.connect(self.host, self.port)
+        ftp.login(self.username, self.password, self.account)
+        if self.cwd is not None:
+            ftp.cwd(self.cwd)
+        return ftp
+
+    def get(self):
+        ftp = getattr(self.local, 'ftp', None)
+        if ftp is None:
+            ftp = self.connect()
+            self.local.ftp = ftp
+            with self.lock:
+                self.connections.append(ftp)
+        return ftp
+
+    def features(self):
+        if self.feats is None:
+            self.feats = features(self.get())
+        return self.feats
+
+    def hashcommand(self):
+        """How the server hashes with the -c algorithm: the HASH algorithm
+        name or None, the command and the field of its reply holding the
+        digest. None if it cannot"""
+        algorithm = globals['checksum']
+        feats = self.features()
+        name = self.hash_names[algorithm]
+        if name in feats.get('HASH', '').replace('*', '').upper().split(';'):
+            return name, 'HASH', 3
+        if algorithm == 'md5' and 'XMD5' in feats:
+            return None, 'XMD5', 1
+        if algorithm == 'crc32' and 'XCRC' in feats:
+            return None, 'XCRC', 1
+        return None
+
+    def checksum(self, path):
+        """Digest computed by the server (HASH, XMD5 or XCRC), None if unsupported"""
+        command = self.hashcommand()
+        if command is None:
+            return None
+        name, verb, field = command
+        ftp = self.get()
+        try:
+            if name is not None and getattr(ftp, 'hash_algorithm', None) != name:
+                ftp.sendcmd('OPTS HASH %s' % name)
+                ftp.hash_algorithm = name
+            value = ftp.sendcmd('%s %s' % (verb, path)).split()[field]
+        except (ftplib.error_temp, ftplib.error_perm, IndexError):
+            return None
+        return '%s:%s' % (globals['checksum'], value.lower())
+
+    def discard(self):
+        ftp = getattr(self.local, 'ftp', None)
+        if ftp is None:
+            return
+        self.local.ftp = None
+        with self.lock:
+            self.connections.remove(ftp)
+        ftp.close()
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for ftp in connections:
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                ftp.close()
+
+
+class asyncFTP:
+    """FTP session on asyncio streams. Transfers await its coroutines on the
+    event loop of the pool, listings and removals use the same blocking
+    methods as on ftplib.FTP, each call run on that loop"""
+
+    encoding = 'utf-8'
+
+    def __init__(self, pool, name=None):
+        self.pool = pool
+        self.name = name
+        self.host = None
+        self.reader = None
+        self.writer = None
+        self.hash_algorithm = None
+
+    def call(self, coro):
+        return self.pool.call(coro)
+
+    async def readline(self):
+        line = await asyncio.wait_for(self.reader.readline(), 300)
+        if not line:
+            raise EOFError('Connection closed by server')
+        return line.decode('latin-1').rstrip('\r\n')
+
+    async def getresp(self):
+        resp = await self.readline()
+        if resp[3:4] == '-':
+            code = resp[:3]
+            while True:
+                line = await self.readline()
+                resp += '\n' + line
+                if line[:3] == code and line[3:4] != '-':
+                    break
+        log('*resp* %r' % resp, 3)
+        if resp[:1] in ('1', '2', '3'):
+            return resp
+        if resp[:1] == '4':
+            raise ftplib.error_temp(resp)
+        if resp[:1] == '5':
+            raise ftplib.error_perm(resp)
+        raise ftplib.error_proto(resp)
+
+    async def putline(self, line):
+        log('*cmd* %r' % line, 3)
+        self.writer.write(('%s\r\n' % line).encode('latin-1'))
+        await self.writer.drain()
+
+    async def command(self, line, expect=None):
+        await self.putline(line)
+        resp = await self.getresp()
+        if expect is not None and resp[:1] != expect:
+            raise ftplib.error_reply(resp)
+        return resp
+
+    async def aconnect(self, host, port):
+        self.host = host
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(host, port), 300)
+        return await self.getresp()
+
+    async def alogin(self, username, password, account):
+        resp = await self.command('USER %s' % username)
+        if resp[:1] == '3':
+            resp = await self.command('PASS %s' % password)
+        if resp[:1] == '3':
+            resp = await self.command('ACCT %s' % account)
+        if resp[:1] != '2':
+            raise ftplib.error_reply(resp)
+        return resp
+
+    async def opendata(self, cmd, rest=None, protocol=None):
+        """Open a data connection for cmd, as streams or as the transport of
+        protocol when given"""
+        try:
+            host, port = ftplib.parse229(await self.command('EPSV', '2'), (self.host,))
+        except ftplib.error_perm:
+            host, port = ftplib.parse227(await self.command('PASV', '2'))
+            host = self.host
+        if protocol is None:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port, limit=globals['blocksize']), 300)
+            transport = writer.transport
+        else:
+            transport, _ = await asyncio.wait_for(
+                asyncio.get_running_loop().create_connection(lambda: protocol, host, port), 300)
+            reader, writer = transport, protocol
+        try:
+            if rest is not None:
+                await self.command('REST %s' % rest, '3')
+            resp = await self.command(cmd)
+            if resp[:1] == '2':
+                resp = await self.getresp()
+            if resp[:1] != '1':
+                raise ftplib.error_reply(resp)
+        except BaseException:
+            transport.close()
+            raise
+        return reader, writer
+
+    async def retrieve(self, cmd, fh, rest=None, digest=None, length=None):
+        """Receive the data of cmd into fh, hashing and rate limiting on the
+        way. Without length the final reply is read too, with it the
+        connection is cut after length bytes and the number of bytes
+        missing returned, the caller reads the reply"""
+        receiver = asyncReceiver(self.name, fh, digest, length)
+        await self.opendata(cmd, rest, receiver)
+        remaining = await receiver.done
+        if length is None:
+            await self.command_done()
+        return remaining
+
+    async def store(self, cmd, fh, offset=0, digest=None):
+        """Send fh from offset as the data of cmd. Without hashing and rate
+        limiting the kernel does the copy with sendfile"""
+        reader, writer = await self.opendata(cmd)
+        loop = asyncio.get_running_loop()
+        try:
+            if digest is None and globals['limiter'] is None:
+                # The loop falls back to a read/write copy where os.sendfile is missing
+                await loop.sendfile(writer.transport, fh, offset)
+                progress(os.fstat(fh.fileno()).st_size - offset)
+            else:
+                fh.seek(offset)
+                while True:
+                    data = fh.read(globals['blocksize'])
+                    if not data:
+                        break
+                    if digest is not None:
+                        digest.update(data)
+                    writer.write(data)
+                    await asyncio.wait_for(writer.drain(), 300)
+                    progress(len(data))
+                    delay = globals['limiter'] is not None and globals['limiter'].delay(len(data), self.name)
+                    if delay:
+                        await asyncio.sleep(delay)
+        finally:
+            writer.close()
+        await self.command_done()
+
+    async def retrievelines(self, cmd):
+        await self.command('TYPE A', '2')
+        reader, writer = await self.opendata(cmd)
+        lines = []
+        try:
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 300)
+                if not line:
+                    break
+                lines.append(line.decode(self.encoding).rstrip('\r\n'))
+        finally:
+            writer.close()
+        await self.command_done()
+        return lines
+
+    async def storelines(self, cmd, fh):
+        await self.command('TYPE A', '2')
+        reader, writer = await self.opendata(cmd)
+        try:
+            for line in fh:
+                writer.write(line.rstrip(b'\r\n') + b'\r\n')
+                await writer.drain()
+        finally:
+            writer.close()
+        await self.command_done()
+
+    async def command_done(self):
+        resp = await self.getresp()
+        if resp[:1] != '2':
+            raise ftplib.error_reply(resp)
+        return resp
+
+    async def asize(self, path):
+        resp = await self.command('SIZE %s' % path)
+        if resp[:3] == '213':
+            return int(resp[3:].strip())
+
+    async def adelete(self, path):
+        resp = await self.command('DELE %s' % path)
+        if resp[:3] not in ('250', '200'):
+            raise ftplib.error_reply(resp)
+        return resp
+
+    async def arename(self, src, dst):
+        await self.command('RNFR %s' % src, '3')
+        return await self.command('RNTO %s' % dst, '2')
+
+    async def checksum(self, path):
+        """connectionPool.checksum on this session"""
+        command = self.pool.hashcommand()
+        if command is None:
+            return None
+        name, verb, field = command
+        try:
+            if name is not None and self.hash_algorithm != name:
+                await self.command('OPTS HASH %s' % name)
+                self.hash_algorithm = name
+            value = (await self.command('%s %s' % (verb, path))).split()[field]
+        except (ftplib.error_temp, ftplib.error_perm, IndexError):
+            return None
+        return '%s:%s' % (globals['checksum'], value.lower())
+
+    # Blocking interface, the subset of ftplib.FTP the handlers use
+
+    def connect(self, host, port):
+        return self.call(self.aconnect(host, port))
+
+    def login(self, username, password, account):
+        return self.call(self.alogin(username, password, account))
+
+    def sendcmd(self, cmd):
+        return self.call(self.command(cmd))
+
+    def voidcmd(self, cmd):
+        return self.call(self.command(cmd, '2'))
+
+    def voidresp(self):
+        return self.call(self.command_done())
+
+    def putcmd(self, cmd):
+        return self.call(self.putline(cmd))
+
+    def retrlines(self, cmd, callback):
+        for line in self.call(self.retrievelines(cmd)):
+            callback(line)
+
+    def storlines(self, cmd, fh):
+        return self.call(self.storelines(cmd, fh))
+
+    def dir(self, *args):
+        callback = print
+        if args and callable(args[-1]):
+            args, callback = args[:-1], args[-1]
+        self.retrlines(' '.join(('LIST',) + args), callback)
+
+    def mlsd(self, path=''):
+        for line in self.call(self.retrievelines(path and 'MLSD %s' % path or 'MLSD')):
+            facts_found, _, name = line.partition(' ')
+            entry = {}
+            for fact in facts_found[:-1].split(';'):
+                key, _, value = fact.partition('=')
+                entry[key.lower()] = value
+            yield name, entry
+
+    def size(self, path):
+        return self.call(self.asize(path))
+
+    def cwd(self, path):
+        return self.voidcmd('CWD %s' % path)
+
+    def mkd(self, path):
+        return self.voidcmd('MKD %s' % path)
+
+    def rmd(self, path):
+        return self.voidcmd('RMD %s' % path)
+
+    def delete(self, path):
+        return self.call(self.adelete(path))
+
+    def rename(self, src, dst):
+        return self.call(self.arename(src, dst))
+
+    def quit(self):
+        try:
+            return self.voidcmd('QUIT')
+        finally:
+            self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.pool.loop.call_soon_threadsafe(self.writer.close)
+            self.writer = None
+
+
+class asyncReceiver(asyncio.BufferedProtocol):
+    """Data connection of a retrieve, written to the file straight from one
+    reusable buffer. Rate limiting pauses reading rather than the loop"""
+
+    def __init__(self, worker, fh, digest=None, length=None):
+        self.worker = worker
+        self.fh = fh
+        self.digest = digest
+        self.length = length
+        self.buffer = memoryview(bytearray(globals['blocksize']))
+        self.transport = None
+        self.done = asyncio.get_running_loop().create_future()
+        self.active = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.active = time.monotonic()
+        self.watch()
+
+    def watch(self):
+        if self.done.done():
+            return
+        idle = time.monotonic() - self.active
+        if idle >= 300:
+            self.transport.abort()
+            self.finish(TimeoutError('Data connection timed out'))
+        else:
+            asyncio.get_running_loop().call_later(300 - idle, self.watch)
+
+    def get_buffer(self, sizehint):
+        if self.length is None:
+            return self.buffer
+        return self.buffer[:min(self.length, len(self.buffer))]
+
+    def buffer_updated(self, size):
+        self.active = time.monotonic()
+        view = self.buffer[:size]
+        self.fh.write(view)
+        if self.digest is not None:
+            self.digest.update(view)
+        progress(size)
+        if self.length is not None:
+            self.length -= size
+            if not self.length:
+                self.transport.close()
+                return
+        delay = globals['limiter'] is not None and globals['limiter'].delay(size, self.worker)
+        if delay:
+            self.transport.pause_reading()
+            asyncio.get_running_loop().call_later(delay, self.resume)
+
+    def resume(self):
+        if not self.transport.is_closing():
+            self.active = time.monotonic()
+            self.transport.resume_reading()
+
+    def eof_received(self):
+        return False
+
+    def connection_lost(self, exc):
+        self.finish(exc)
+
+    def finish(self, exc=None):
+        if self.done.done():
+            return
+        if exc is not None:
+            self.done.set_exception(exc)
+        else:
+            self.done.set_result(self.length or 0)
+
+
+class asyncPool(connectionPool):
+    """Connection pool of asyncFTP sessions. All control and data channels
+    are non-blocking streams driven by one event loop thread. Transfers run
+    on that thread as coroutines holding sessions of their own, other
+    threads get a session each and wait on the loop for its results"""
+
+    def __init__(self, host, port, username, password, account):
+        connectionPool.__init__(self, host, port, username, password, account)
+        self.sessions = itertools.count()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='asyncio', daemon=True)
+        self.thread.start()
+
+    def call(self, coro):
+        if threading.current_thread() is self.thread:
+            coro.close()
+            raise RuntimeError('Blocking call on the event loop thread')
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def open(self):
+        """A new session for a coroutine on the loop"""
+        ftp = asyncFTP(self, 'session_%i' % next(self.sessions))
+        await ftp.aconnect(self.host, self.port)
+        try:
+            await ftp.alogin(self.username, self.password, self.account)
+            if self.cwd is not None:
+                await ftp.command('CWD %s' % self.cwd, '2')
+        except BaseException:
+            ftp.close()
+            raise
+        with self.lock:
+            self.connections.append(ftp)
+        return ftp
+
+    def drop(self, sessions):
+        with self.lock:
+            for ftp in sessions:
+                if ftp in self.connections:
+                    self.connections.remove(ftp)
+        for ftp in sessions:
+            ftp.close()
+
+    def connect(self):
+        ftp = asyncFTP(self, threading.current_thread().name)
+        ftp.connect(self.host, self.port)
+        ftp.login(self.username, self.password, self.account)
+        if self.cwd is not None:
+            ftp.cwd(self.cwd)
+        return ftp
+
+    def close(self):
+        connectionPool.close(self)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+class tlsFTP(ftplib.FTP_TLS):
+    """Explicit FTPS. Data channels resume the TLS session of the control
+    channel, which saves a full handshake per file and is required by
+    servers enforcing session reuse"""
+
+    def ntransfercmd(self, cmd, rest=None):
+        conn, size = ftplib.FTP.ntransfercmd(self, cmd, rest)
+        if self._prot_p:
+            conn = self.context.wrap_socket(conn, server_hostname=self.host, session=self.sock.session)
+        return conn, size
+
+
+class tlsPool(connectionPool):
+    """Connection pool of explicit FTPS sessions with protected data channels"""
+
+    def connect(self):
+        ftp = tlsFTP(context=ssl.create_default_context(), timeout=300)
+        if globals['verbose'] > 2:
+            ftp.set_debuglevel(globals['verbose'] - 2)
+        ftp.connect(self.host, self.port)
+        ftp.login(self.username, self.password, self.account)
+        ftp.prot_p()
+        if self.cwd is not None:
+            ftp.cwd(self.cwd)
+        return ftp
+
+
+def permanent(func):
+    """Report missing files and refused operations of a transport as 550
+    replies, like an FTP server would, so retry() does not repeat them"""
+    def wrapper(*args):
+        try:
+            return func(*args)
+        except (FileNotFoundError, FileExistsError, PermissionError,
+                IsADirectoryError, NotADirectoryError) as err:
+            raise ftplib.error_perm('550 %s' % (err.strerror or err))
+    return wrapper
+
+
+class fileSession:
+    """Session of a transport other than FTP. Provides the subset of
+    ftplib.FTP the handlers use on top of stat, listdir and open style
+    primitives implemented by the subclasses"""
+
+    scheme = None
+    readonly = False
+    pending = ()
+
+    def sendcmd(self, cmd):
+        verb, _, arg = cmd.partition(' ')
+        verb = verb.upper()
+        if verb == 'TYPE':
+            return '200 Type set to %s' % arg
+        if verb == 'REST':
+            return '350 Restarting at %s' % arg
+        if verb == 'FEAT':
+            return '211-Features:\n MLST type*;size*;modify*;\n211 End'
+        raise ftplib.error_perm('502 %s not supported by %s' % (verb, self.scheme))
+
+    voidcmd = sendcmd
+
+    def putcmd(self, cmd):
+        # Nothing to pipeline, the command runs when its reply is asked for
+        self.pending = list(self.pending) + [cmd]
+
+    def voidresp(self):
+        if not self.pending:
+            return '226 Transfer complete'
+        verb, _, path = self.pending.pop(0).partition(' ')
+        if verb not in ('DELE', 'RMD'):
+            raise ftplib.error_perm('502 %s not supported by %s' % (verb, self.scheme))
+        getattr(self, verb == 'DELE' and 'delete' or 'rmd')(path)
+        return '250 %s done' % verb
+
+    def writable(self):
+        if self.readonly:
+            raise ftplib.error_perm('550 %s is read-only' % self.scheme)
+
+    @permanent
+    def cwd(self, path):
+        if not self.stat(path.rstrip('/') + '/')['dir']:
+            raise NotADirectoryError(20, 'Not a directory: %s' % path)
+        return '250 OK'
+
+    @permanent
+    def size(self, path):
+        return self.stat(path)['size']
+
+    @permanent
+    def mlsd(self, path='/'):
+        return [(name, {
+            'type': entry['dir'] and 'dir' or 'file',
+            'size': str(entry['size']),
+            'modify': time.strftime('%Y%m%d%H%M%S', time.gmtime(entry['mtime'])),
+        }) for name, entry in self.listdir(path)]
+
+    def dir(self, *args):
+        callback = print
+        if args and callable(args[-1]):
+            args, callback = args[:-1], args[-1]
+        paths = [arg for arg in args if not arg.startswith('-')]
+        for name, entry in self.mlsd(paths and paths[-1] or '/'):
+            mtime = time.localtime(int(calendar.timegm(time.strptime(entry['modify'], '%Y%m%d%H%M%S'))))
+            callback('%s 1 owner group %12s %s %s' % (
+                entry['type'] == 'dir' and 'drwxr-xr-x' or '-rw-r--r--', entry['size'],
+                time.strftime('%b %d %Y', mtime), name))
+
+    @permanent
+    def transfercmd(self, cmd, rest=None):
+        verb, _, path = cmd.partition(' ')
+        if verb == 'RETR':
+            return self.openread(path, rest or 0)
+        self.writable()
+        return self.openwrite(path, verb == 'APPE')
+
+    def retrlines(self, cmd, callback):
+        conn = self.transfercmd(cmd)
+        buffer = BytesIO()
+        try:
+            view = memoryview(bytearray(globals['blocksize']))
+            while True:
+                size = conn.recv_into(view)
+                if not size:
+                    break
+                buffer.write(view[:size])
+        finally:
+            conn.close()
+        for line in buffer.getvalue().decode('utf-8').splitlines():
+            callback(line)
+
+    def storlines(self, cmd, fh):
+        conn = self.transfercmd(cmd)
+        try:
+            conn.sendall(fh.read())
+        finally:
+            conn.close()
+
+    @permanent
+    def delete(self, path):
+        self.writable()
+        self.remove(path)
+
+    @permanent
+    def rename(self, src, dst):
+        self.writable()
+        self.move(src, dst)
+
+    @permanent
+    def mkd(self, path):
+        self.writable()
+        self.mkdir(path)
+
+    @permanent
+    def rmd(self, path):
+        self.writable()
+        self.rmdir(path)
+
+    def quit(self):
+        self.close()
+
+    def close(self):
+        pass
+
+
+class localSession(fileSession):
+    """Local filesystem as a transport, for local to local mirrors. Copies
+    into files go through sendfile, so the kernel moves the data"""
+
+    scheme = 'file'
+
+    def stat(self, path):
+        st = os.stat(path)
+        return {'dir': os.path.isdir(path), 'size': st.st_size, 'mtime': int(st.st_mtime)}
+
+    def listdir(self, path):
+        for entry in os.scandir(path):
+            st = entry.stat()
+            yield entry.name, {'dir': entry.is_dir(), 'size': st.st_size, 'mtime': int(st.st_mtime)}
+
+    def openread(self, path, offset):
+        fh = open(path, 'rb')
+        fh.seek(offset)
+        return localData(fh)
+
+    def openwrite(self, path, append):
+        return localData(open(path, append and 'ab' or 'wb'))
+
+    def remove(self, path):
+        os.remove(path)
+
+    def move(self, src, dst):
+        os.replace(src, dst)
+
+    def mkdir(self, path):
+        os.mkdir(path)
+
+    def rmdir(self, path):
+        os.rmdir(path)
+
+
+class localData:
+    """Open file of a localSession, looks like a data connection"""
+
+    def __init__(self, fh):
+        self.fh = fh
+
+    def recv_into(self, view):
+        return self.fh.readinto(view)
+
+    def sendall(self, data):
+        self.fh.write(data)
+
+    def sendfile(self, fh, offset=0):
+        self.fh.flush()
+        while True:
+            sent = os.sendfile(self.fh.fileno(), fh.fileno(), offset, globals['blocksize'] * 64)
+            if not sent:
+                break
+            offset += sent
+
+    def close(self):
+        self.fh.close()
+
+
+class sftpSession(fileSession):
+    """SFTP over paramiko. Reads are prefetched and writes pipelined, so a
+    transfer is not bound by one round-trip per block"""
+
+    scheme = 'sftp'
+
+    def __init__(self, host, port, username, password):
+        # Only servers whose key is already known are trusted
+        name = port == 22 and host or '[%s]:%i' % (host, port)
+        hostkeys = paramiko.HostKeys()
+        known_hosts = os.path.expanduser('~/.ssh/known_hosts')
+        if os.path.exists(known_hosts):
+            hostkeys.load(known_hosts)
+        known = hostkeys.lookup(name)
+        if not known:
+            raise ftplib.error_perm('530 No host key for %s in %s' % (name, known_hosts))
+        self.transport = paramiko.Transport((host, port))
+        self.transport.set_keepalive(60)
+        self.transport.connect(hostkey=next(iter(known.values())), username=username, password=password or None)
+        self.sftp = paramiko.SFTPClient.from_transport(self.transport, window_size=2 ** 27,
+                                                       max_packet_size=2 ** 15)
+        self.sftp.get_channel().settimeout(300)
+
+    def stat(self, path):
+        st = self.sftp.stat(path)
+        return {'dir': statlib.S_ISDIR(st.st_mode), 'size': st.st_size, 'mtime': int(st.st_mtime)}
+
+    def listdir(self, path):
+        for st in self.sftp.listdir_attr(path):
+            yield st.filename, {'dir': statlib.S_ISDIR(st.st_mode), 'size': st.st_size,
+                                'mtime': int(st.st_mtime)}
+
+    def openread(self, path, offset):
+        fh = self.sftp.open(path, 'rb', globals['blocksize'])
+        fh.seek(offset)
+        fh.prefetch(fh.stat().st_size - offset)
+        return sftpData(fh)
+
+    def openwrite(self, path, append):
+        fh = self.sftp.open(path, append and 'ab' or 'wb', globals['blocksize'])
+        fh.set_pipelined(True)
+        return sftpData(fh)
+
+    def remove(self, path):
+        self.sftp.remove(path)
+
+    def move(self, src, dst):
+        self.sftp.posix_rename(src, dst)
+
+    def mkdir(self, path):
+        self.sftp.mkdir(path)
+
+    def rmdir(self, path):
+        self.sftp.rmdir(path)
+
+    def close(self):
+        self.transport.close()
+
+
+class sftpData:
+    """Open remote file of an sftpSession, looks like a data connection"""
+
+    def __init__(self, fh):
+        self.fh = fh
+
+    def recv_into(self, view):
+        data = self.fh.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def sendall(self, data):
+        self.fh.write(bytes(data))
+
+    def sendfile(self, fh, offset=0):
+        fh.seek(offset)
+        buffer = memoryview(bytearray(globals['blocksize']))
+        while True:
+            size = fh.readinto(buffer)
+            if not size:
+                break
+            self.fh.write(bytes(buffer[:size]))
+
+    def close(self):
+        self.fh.close()
+
+
+class httpSession(fileSession):
+    """HTTP(S) directory indexes as a read-only source. Each session keeps
+    one connection alive, resume and segments use Range requests"""
+
+    readonly = True
+
+    # Anchor of an index entry and the date and size columns following it,
+    # as written by Apache, nginx and lighttpd
+    entry = re.compile(r'<a href="([^"?#]+)"[^>]*>.*?</a>\s*([^<\n]*)', re.I)
+    date = re.compile(r'(\d{4}-\d{2}-\d{2}|\d{2}-\w{3}-\d{4}) (\d{2}:\d{2}(?::\d{2})?)')
+
+    def __init__(self, scheme, host, port):
+        self.scheme = scheme
+        if scheme == 'https':
+            self.conn = http.client.HTTPSConnection(host, port, timeout=300)
+        else:
+            self.conn = http.client.HTTPConnection(host, port, timeout=300)
+
+    def request(self, method, path, headers={}):
+        self.conn.request(method, urllib.parse.quote(path), headers=headers)
+        resp = self.conn.getresponse()
+        if resp.status >= 400:
+            resp.read()
+            message = '%s %s: %s' % (resp.status, resp.reason, path)
+            if resp.status >= 500:
+                raise ftplib.error_temp('421 %s' % message)
+            raise ftplib.error_perm('550 %s' % message)
+        return resp
+
+    def stat(self, path):
+        resp = self.request('HEAD', path)
+        resp.read()
+        modified = resp.getheader('Last-Modified')
+        return {
+            'dir': path.endswith('/'),
+            'size': int(resp.getheader('Content-Length') or 0),
+            'mtime': modified and int(email.utils.parsedate_to_datetime(modified).timestamp()) or 0,
+        }
+
+    def listdir(self, path):
+        path = path.rstrip('/') + '/'
+        resp = self.request('GET', path)
+        page = resp.read().decode(resp.headers.get_content_charset() or 'utf-8', 'replace')
+        for href, columns in self.entry.findall(page):
+            if href.startswith(('/', '.')) or '://' in href:
+                continue
+            name = urllib.parse.unquote(href.rstrip('/'))
+            if not name or '/' in name:
+                continue
+            if href.endswith('/'):
+                yield name, {'dir': True, 'size': 0, 'mtime': self.mtime(columns)}
+                continue
+            size = columns.split()[-1:]
+            if size and size[0].isdigit():
+                yield name, {'dir': False, 'size': int(size[0]), 'mtime': self.mtime(columns)}
+            else:
+                # Rounded sizes (1.2M) are of no use for comparing, ask for the exact one
+                yield name, self.stat(path + name)
+
+    def mtime(self, columns):
+        match = self.date.search(columns)
+        if match is None:
+            return 0
+        day, clock = match.groups()
+        format = day[4] == '-' and '%Y-%m-%d' or '%d-%b-%Y'
+        return calendar.timegm(time.strptime('%s %s' % (day, clock[:5]), format + ' %H:%M'))
+
+    def openread(self, path, offset):
+        resp = self.request('GET', path, offset and {'Range': 'bytes=%i-' % offset} or {})
+        data = httpData(self, resp)
+        if offset and resp.status != 206:
+            log('--> Server ignored the range request for %s' % path, 2)
+            data.skip(offset)
+        return data
+
+    def close(self):
+        self.conn.close()
+
+
+class httpData:
+    """Response body of an httpSession, looks like a data connection"""
+
+    def __init__(self, session, resp):
+        self.session = session
+        self.resp = resp
+
+    def recv_into(self, view):
+        return self.resp.readinto(view)
+
+    def skip(self, length):
+        buffer = memoryview(bytearray(globals['blocksize']))
+        while length > 0:
+            size = self.resp.readinto(buffer[:min(length, len(buffer))])
+            if not size:
+                break
+            length -= size
+
+    def close(self):
+        if not self.resp.isclosed():
+            # The rest of the body is not wanted, so the connection cannot be reused
+            self.session.conn.close()
+        self.resp.close()
+
+
+class transportPool(connectionPool):
+    """Connection pool of fileSession transports (file, sftp, http, https),
+    one session per thread like for FTP"""
+
+    def __init__(self, scheme, host, port, username, password, account):
+        connectionPool.__init__(self, host, port, username, password, account)
+        self.scheme = scheme
+
+    def connect(self):
+        if self.scheme == 'file':
+            ftp = localSession()
+        elif self.scheme == 'sftp':
+            ftp = sftpSession(self.host, self.port, self.username, self.password)
+        else:
+            ftp = httpSession(self.scheme, self.host, self.port)
+        if self.cwd is not None:
+            ftp.cwd(self.cwd)
+        return ftp
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for ftp in connections:
+            ftp.close()
+
+
+class transferQueue:
+    """Bounded queue of file transfers worked off by a pool of threads,
+    largest files first. Failed transfers get one more round at the end"""
+
+    def __init__(self, workers, manifest):
+        self.manifest = manifest
+        self.stats = {}
+        self.error = None
+        self.cancelled = False
+        self.failed = []
+        self.queue = queue.PriorityQueue()
+        self.slots = threading.BoundedSemaphore(globals['queue_size'])
+        self.sequence = itertools.count()
+        self.inline = workers <= 1
+        self.threads = []
+        if not self.inline:
+            for i in range(workers):
+                thread = threading.Thread(target=self.work, name='transfer_%i' % i, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def put(self, handler, src, dst, size, key=None, mtime=None):
+        self.check()
+        if globals['metrics'] is not None:
+            globals['metrics'].queue(size)
+        if self.inline:
+            self.transfer(handler, src, dst, size, key, mtime)
+            return
+        self.slots.acquire()
+        self.enqueue((-size, next(self.sequence), (handler, src, dst, size, key, mtime)))
+
+    def enqueue(self, item):
+        self.queue.put(item)
+
+    def work(self):
+        while True:
+            priority, sequence, item = self.queue.get()
+            if item is None:
+                return
+            try:
+                if not self.cancelled:
+                    self.transfer(*item)
+            except Exception as err:
+                if self.error is None:
+                    self.error = err
+            finally:
+                self.slots.release()
+                self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def transfer(self, handler, src, dst, size, key=None, mtime=None):
+        started = time.time()
+
+        def store():
+            # A partial file of another source version is started over
+            resume = self.manifest.resumable_partial(dst, size, mtime)
+            return handler.storefile(src, dst, size, resume)
+
+        try:
+            digest = retry(handler.pool, 'Transfer of %s' % src, store)
+        except ftplib.all_errors as err:
+            self.failure((handler, src, dst, size, key, mtime), err)
+            return
+        self.success(handler, src, dst, size, key, digest, time.time() - started, threading.current_thread().name)
+
+    def failure(self, item, err):
+        handler, src, dst, size, key, mtime = item
+        log('-> Transfer of %s failed: %s' % (src, err))
+        event('transfer_failed', source=src, target=dst, error=str(err))
+        with globals['lock']:
+            self.failed.append((item, err))
+        if key is not None:
+            self.manifest.incomplete(key[0])
+
+    def success(self, handler, src, dst, size, key, digest, elapsed, worker):
+        observe(isinstance(handler, remoteHandler) and 'STOR' or 'RETR', elapsed, size, worker)
+        event('transfer', source=src, target=dst, size=size, seconds=elapsed)
+        self.manifest.transferred(dst)
+        if key is not None:
+            self.manifest.setchecksum(key[0], key[1], digest)
+        with globals['lock']:
+            stats = self.stats.setdefault(worker, {'files': 0, 'bytes': 0, 'seconds': 0.0})
+            stats['files'] += 1
+            stats['bytes'] += size
+            stats['seconds'] += elapsed
+            globals['status']['bytes_transfered'] += size
+
+    def wait(self):
+        self.queue.join()
+
+    def join(self):
+        self.wait()
+        self.check()
+        if self.failed:
+            log('Retrying %i failed transfers' % len(self.failed))
+            failed, self.failed = self.failed, []
+            for item, err in failed:
+                self.put(*item)
+            self.wait()
+            self.check()
+        with globals['lock']:
+            for item, err in self.failed:
+                globals['failures'].append(('Transfer of %s' % item[1], str(err)))
+        self.shutdown()
+
+    def shutdown(self):
+        self.cancelled = True
+        # Sentinels sort after every queued transfer
+        for thread in self.threads:
+            self.queue.put((float('inf'), next(self.sequence), None))
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+class asyncTransferQueue(transferQueue):
+    """transferQueue of the asyncio backend. The transfers are coroutines on
+    the event loop of the pool, each worker holding sessions of its own, so
+    no thread waits on a socket"""
+
+    def __init__(self, workers, manifest, pool):
+        transferQueue.__init__(self, 0, manifest)
+        self.inline = False
+        self.pool = pool
+        if globals['checksum']:
+            # Looked up here, the loop thread must not block on it
+            pool.features()
+        self.workers = pool.call(self.start(workers))
+
+    async def start(self, workers):
+        self.queue = asyncio.PriorityQueue()
+        return [asyncio.ensure_future(self.work(asyncWorker(self.pool, 'transfer_%i' % i)))
+                for i in range(workers)]
+
+    def enqueue(self, item):
+        self.pool.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+    async def work(self, worker):
+        while True:
+            priority, sequence, item = await self.queue.get()
+            if item is None:
+                return
+            try:
+                if not self.cancelled:
+                    await self.transfer(worker, *item)
+            except Exception as err:
+                if self.error is None:
+                    self.error = err
+            finally:
+                self.slots.release()
+                self.queue.task_done()
+
+    async def transfer(self, worker, handler, src, dst, size, key=None, mtime=None):
+        started = time.time()
+
+        async def store():
+            resume = self.manifest.resumable_partial(dst, size, mtime)
+            return await handler.astorefile(worker, src, dst, size, resume)
+
+        try:
+            digest = await aretry('Transfer of %s' % src, store, worker.drop)
+        except ftplib.all_errors as err:
+            self.failure((handler, src, dst, size, key, mtime), err)
+            return
+        self.success(handler, src, dst, size, key, digest, time.time() - started, worker.name)
+
+    def wait(self):
+        self.pool.call(self.queue.join())
+
+    def shutdown(self):
+        self.cancelled = True
+        workers, self.workers = self.workers, []
+        if workers:
+            self.pool.call(self.stop(workers))
+
+    async def stop(self, workers):
+        # Sentinels sort after every queued transfer
+        for worker in workers:
+            self.queue.put_nowait((float('inf'), next(self.sequence), None))
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+class asyncWorker:
+    """Sessions of one transfer coroutine: the first for whole files, one
+    more per segment of a segmented download"""
+
+    def __init__(self, pool, name):
+        self.pool = pool
+        self.name = name
+        self.sessions = []
+
+    async def session(self, index=0):
+        while len(self.sessions) <= index:
+            self.sessions.append(None)
+        if self.sessions[index] is None:
+            self.sessions[index] = await self.pool.open()
+        return self.sessions[index]
+
+    def discard(self, index):
+        if self.sessions[index] is not None:
+            self.pool.drop([self.sessions[index]])
+            self.sessions[index] = None
+
+    def drop(self):
+        self.pool.drop([ftp for ftp in self.sessions if ftp is not None])
+        self.sessions = []
+
+
+def removers():
+    """The threads all removals of the run share. Every thread logs in once
+    and keeps its connection until the pool is closed, so they are only
+    started once"""
+    with globals['lock']:
+        if globals['removers'] is None:
+            globals['removers'] = ThreadPoolExecutor(max(globals['jobs'], globals['scanners']), 'remove')
+        return globals['removers']
+
+
+def removebatches(handler, method, paths, progress=None):
+    """Run method on batches of paths, in parallel on the removal
+    connections. Each batch is pipelined on its connection"""
+    batches = [paths[i:i + 100] for i in range(0, len(paths), 100)]
+    if len(batches) == 1:
+        retry(handler.pool, 'Removal in %s' % os.path.dirname(paths[0]), method, batches[0])
+        if progress is not None:
+            progress(len(paths))
+        return
+    futures = dict((removers().submit(retry, handler.pool, 'Removal in %s' % os.path.dirname(batch[0]),
+                                      method, batch), len(batch)) for batch in batches)
+    # A failed batch does not stop the others, its first error is raised at the end
+    error = None
+    for future in as_completed(futures):
+        try:
+            future.result()
+        except ftplib.all_errors as err:
+            error = error or err
+            continue
+        if progress is not None:
+            progress(futures[future])
+    if error is not None:
+        raise error
+
+
+def removetree(handler, path, keep_root=False):
+    """Remove a whole tree in few round-trips: list it breadth-first on
+    several connections, delete the files in pipelined batches, then remove
+    the directories deepest level first"""
+    levels = [[path]]
+    files = []
+    while levels[-1]:
+        level = []
+        listings = removers().map(lambda dir: (dir, retry(handler.pool, 'Listing of %s' % dir,
+                                                          handler.list, dir, True)), levels[-1])
+        for dir, (dirs, names) in listings:
+            level.extend(os.path.join(dir, name) for name in dirs)
+            files.extend(os.path.join(dir, name) for name in names)
+        levels.append(level)
+    if keep_root:
+        levels[0] = []
+    total = len(files) + sum(len(level) for level in levels)
+    done = [0, time.time()]
+
+    def progress(size):
+        done[0] += size
+        if time.time() - done[1] > 5:
+            done[1] = time.time()
+            log('--> Removed %i of %i entries in %s' % (done[0], total, path))
+
+    error = None
+    if files:
+        try:
+            removebatches(handler, handler.removefiles, files, progress)
+        except ftplib.all_errors as err:
+            error = err
+    for level in reversed(levels):
+        if level:
+            try:
+                removebatches(handler, handler.removedirs, level, progress)
+            except ftplib.all_errors as err:
+                error = error or err
+    if error is not None:
+        raise error
+
+
+class syncPlan:
+    """Actions decided by the comparison, carried out right away or only
+    recorded on a dry run"""
+
+    def __init__(self, dst, transfers, manifest, dry_run=False):
+        self.dst = dst
+        self.transfers = transfers
+        self.manifest = manifest
+        self.dry_run = dry_run
+        self.resumed = set()
+        self.removals = []
+        self.deferred = []
+        self.deferred_files = []
+        self.trashdirs = set()
+        self.actions = []
+        self.totals = {}
+
+    def record(self, action, path, size=0, source=''):
+        with globals['lock']:
+            totals = self.totals.setdefault(action, {'count': 0, 'bytes': 0})
+            totals['count'] += 1
+            totals['bytes'] += size
+            if self.dry_run:
+                self.actions.append({'action': action, 'path': path, 'size': size, 'source': source})
+
+    def mkdir(self, path):
+        log('-> Create directory %s' % path)
+        self.record('mkdir', path)
+        if not self.dry_run:
+            retry(self.dst.pool, 'Create directory %s' % path, self.dst.makedir, path)
+
+    def rmdir(self, path, size=0):
+        log('-> Remove directory %s' % path)
+        self.record('rmdir', path, size)
+        if self.dry_run:
+            return
+        mode = globals['deletion'] or 'delete'
+        # A removal that fails is reported, the rest of the run goes on
+        try:
+            if mode.startswith('trash:'):
+                self.trash(path, mode[6:])
+                count('dirs_removed')
+            elif mode == 'rename' and not path.endswith(self.suffix):
+                # The tree leaves the mirror right away but is only deleted at
+                # the end of the run, an interrupted run leaves it to the next one
+                log('--> Rename %s to %s' % (path, path + self.suffix), 2)
+                retry(self.dst.pool, 'Rename of %s' % path, self.dst.rename, path, path + self.suffix)
+                self.deferred.append(path + self.suffix)
+            else:
+                removetree(self.dst, path)
+        except ftplib.all_errors as err:
+            fail('Removal of %s' % path, err)
+
+    def remove(self, path, size):
+        log('-> Remove file %s: %s' % (path, strfbytes(size)))
+        self.record('remove', path, size)
+        if self.dry_run:
+            return
+        mode = globals['deletion'] or 'delete'
+        if not mode.startswith('trash:') and (mode != 'rename' or path.endswith(self.suffix)):
+            self.removals.append(path)
+            return
+        try:
+            if mode == 'rename':
+                log('--> Rename %s to %s' % (path, path + self.suffix), 2)
+                retry(self.dst.pool, 'Rename of %s' % path, self.dst.rename, path, path + self.suffix)
+                self.deferred_files.append(path + self.suffix)
+            else:
+                self.trash(path, mode[6:])
+                count('files_removed')
+        except ftplib.all_errors as err:
+            fail('Removal of %s' % path, err)
+
+    # Files and directories renamed for deletion at the end of the run
+    suffix = '.sfm-deleted'
+
+    def trash(self, path, trash):
+        """Move path to the same relative path below a directory of this run
+        in the trash, so equal names never overwrite each other"""
+        if not self.trashdirs:
+            self.trashdirs.add(self.maketrash(trash))
+        root = min(self.trashdirs, key=len)
+        target = os.path.join(root, os.path.relpath(path, self.dst.root))
+        parents = []
+        parent = os.path.dirname(target)
+        while parent not in self.trashdirs:
+            parents.append(parent)
+            parent = os.path.dirname(parent)
+        for parent in reversed(parents):
+            retry(self.dst.pool, 'Create directory %s' % parent, self.dst.makedir, parent, False)
+            self.trashdirs.add(parent)
+        log('--> Move %s to %s' % (path, target), 2)
+        retry(self.dst.pool, 'Move of %s to the trash' % path, self.dst.rename, path, target)
+
+    def maketrash(self, trash):
+        stamp = time.strftime('%Y%m%d%H%M%S')
+        for attempt in range(10):
+            path = os.path.join(trash, attempt and '%s.%i' % (stamp, attempt) or stamp)
+            try:
+                self.dst.makedir(path, False)
+                return path
+            except (ftplib.error_perm, OSError) as err:
+                # Taken by an earlier run, never move into it
+                error = err
+        raise error
+
+    def flush(self):
+        """Delete the files collected by remove() in pipelined batches"""
+        removals, self.removals = self.removals, []
+        if removals:
+            try:
+                removebatches(self.dst, self.dst.removefiles, removals)
+            except ftplib.all_errors as err:
+                fail('Removal in %s' % os.path.dirname(removals[0]), err)
+
+    def finish(self):
+        files, self.deferred_files = self.deferred_files, []
+        if files:
+            log('-> Purge %i renamed files' % len(files))
+            try:
+                removebatches(self.dst, self.dst.removefiles, files)
+            except ftplib.all_errors as err:
+                fail('Purge in %s' % os.path.dirname(files[0]), err)
+        for path in self.deferred:
+            log('-> Purge %s' % path)
+            try:
+                removetree(self.dst, path)
+            except ftplib.all_errors as err:
+                fail('Purge of %s' % path, err)
+        self.deferred = []
+
+    def transfer(self, src, dst, size, update=False, key=None, mtime=None):
+        if dst in self.resumed:
+            return
+        if update:
+            log('-> Update file %s: %s' % (dst, strfbytes(size)))
+            self.record('update', dst, size, src)
+            count('files_updated')
+        else:
+            log('-> Create file %s: %s' % (dst, strfbytes(size)))
+            self.record('create', dst, size, src)
+            count('files_created')
+        if not self.dry_run:
+            self.manifest.queued(src, dst, size, key, mtime)
+            self.transfers.put(self.dst, src, dst, size, key, mtime)
+
+    def resume(self):
+        transfers = self.manifest.pending_transfers()
+        log('Resuming %i queued transfers' % len(transfers))
+        for src, dst, size, key, mtime in transfers:
+            self.resumed.add(dst)
+            self.transfers.put(self.dst, src, dst, size, key, mtime)
+
+    def write(self, path, estimate=None):
+        fh = open(path, 'w')
+        if path.endswith('.json'):
+            json.dump({
+                'actions': self.actions,
+                'totals': self.totals,
+                'estimated_seconds': estimate,
+            }, fh, indent=1)
+        else:
+            fh.write('action\tsize\tpath\tsource\n')
+            for action in self.actions:
+                fh.write('%(action)s\t%(size)i\t%(path)s\t%(source)s\n' % action)
+        fh.close()
+
+
+class syncManifest:
+    """Index of mirrored entries, kept in a local SQLite database"""
 
+    # Applied in order, PRAGMA user_version records how many already ran
+    schema = [
+        'CREATE TABLE mirrors (id INTEGER PRIMARY KEY, target TEXT UNIQUE, source TEXT, '
+        'last_updated INTEGER)',
+        'CREATE TABLE dirs (mirror INTEGER, path TEXT, synced INTEGER, PRIMARY KEY (mirror, path))',
+        'CREATE TABLE files (mirror INTEGER, dir TEXT, name TEXT, size INTEGER, mtime INTEGER, '
+        'checksum TEXT, synced INTEGER, PRIMARY KEY (mirror, dir, name))',
+        'ALTER TABLE dirs ADD COLUMN mtime INTEGER',
+        'ALTER TABLE dirs ADD COLUMN hash TEXT',
+        'ALTER TABLE mirrors ADD COLUMN last_verified INTEGER',
+        'CREATE TABLE runs (mirror INTEGER, finished INTEGER, bytes INTEGER, seconds REAL)',
+        # Progress of the running sync: directories still to scan, queued
+        # transfers and completed directories, cleared once the run finishes
+        'CREATE TABLE journal (mirror INTEGER, kind TEXT, path TEXT, name TEXT, src TEXT, dst TEXT, '
+        'size INTEGER, mtime INTEGER, hash TEXT, present INTEGER)',
+        'CREATE INDEX journal_dst ON journal (mirror, kind, dst)',
+        'ALTER TABLE mirrors ADD COLUMN deletion TEXT',
+        'CREATE TABLE listings (host TEXT, path TEXT, fetched REAL, mtimes INTEGER, dirs TEXT, files TEXT, '
+        'PRIMARY KEY (host, path))',
+        # Source version each partial file was started from, kept across runs
+        'CREATE TABLE partials (mirror INTEGER, dst TEXT, size INTEGER, mtime INTEGER, PRIMARY KEY (mirror, dst))',
+    ]
+
+    def __init__(self, path, readonly=False):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.readonly = readonly
+        self.id = None
+        self.failed = set()
+        # The journal is written for every directory and transfer
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        for statement in self.schema[version:]:
+            self.db.execute(statement)
+        self.db.execute('PRAGMA user_version = %i' % len(self.schema))
+        self.db.commit()
+
+    def source(self, target):
+        with self.lock:
+            row = self.db.execute('SELECT source FROM mirrors WHERE target = ?', (target,)).fetchone()
+        return row and row[0]
+
+    def open(self, target, source):
+        with self.lock:
+            if self.readonly:
+                row = self.db.execute('SELECT id FROM mirrors WHERE target = ?', (target,)).fetchone()
+                self.id = row and row[0]
+                return
+            self.db.execute('INSERT OR IGNORE INTO mirrors (target, source, last_updated) VALUES (?, ?, 0)',
+                            (target, source))
+            self.db.execute('UPDATE mirrors SET source = ? WHERE target = ?', (source, target))
+            self.id = self.db.execute('SELECT id FROM mirrors WHERE target = ?', (target,)).fetchone()[0]
+            self.db.commit()
+
+    def forget(self, target):
+        if self.readonly:
+            return
+        with self.lock:
+            row = self.db.execute('SELECT id FROM mirrors WHERE target = ?', (target,)).fetchone()
+            if row:
+                for table in ('files', 'dirs', 'runs', 'journal', 'partials'):
+                    self.db.execute('DELETE FROM %s WHERE mirror = ?' % table, row)
+                self.db.execute('DELETE FROM mirrors WHERE id = ?', row)
+                self.db.commit()
+
+    def known(self, dir):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM dirs WHERE mirror = ? AND path = ?',
+                                   (self.id, dir)).fetchone() is not None
+
+    def files(self, dir):
+        with self.lock:
+            rows = self.db.execute('SELECT name, size, mtime, checksum, synced FROM files '
+                                   'WHERE mirror = ? AND dir = ?', (self.id, dir)).fetchall()
+        return dict((name, {'size': size, 'mtime': mtime or 0, 'checksum': checksum, 'synced': synced})
+                    for name, size, mtime, checksum, synced in rows)
+
+    def update(self, dir, files):
+        if self.readonly:
+            return
+        now = int(time.time())
+        with self.lock:
+            names = set(row[0] for row in self.db.execute(
+                'SELECT name FROM files WHERE mirror = ? AND dir = ?', (self.id, dir)))
+            self.db.executemany('DELETE FROM files WHERE mirror = ? AND dir = ? AND name = ?',
+                                [(self.id, dir, name) for name in names if name not in files])
+            # Cached checksums stay valid as long as size and mtime do
+            self.db.executemany(
+                'INSERT INTO files (mirror, dir, name, size, mtime, checksum, synced) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (mirror, dir, name) DO UPDATE SET '
+                'checksum = coalesce(excluded.checksum, CASE WHEN size = excluded.size '
+                'AND mtime = coalesce(excluded.mtime, mtime) THEN checksum END), '
+                'size = excluded.size, mtime = coalesce(excluded.mtime, mtime), synced = excluded.synced',
+                [(self.id, dir, name, files[name]['size'], files[name]['mtime'],
+                  files[name].get('checksum'), now) for name in files])
+            # The directory only becomes prunable again once complete() is flushed
+            self.db.execute('INSERT INTO dirs (mirror, path, synced) VALUES (?, ?, ?) '
+                            'ON CONFLICT (mirror, path) DO UPDATE SET '
+                            'synced = excluded.synced, mtime = NULL, hash = NULL',
+                            (self.id, dir, now))
+            self.db.commit()
+
+    def setchecksum(self, dir, name, checksum):
+        if self.readonly or checksum is None:
+            return
+        with self.lock:
+            self.db.execute('UPDATE files SET checksum = ? WHERE mirror = ? AND dir = ? AND name = ?',
+                            (checksum, self.id, dir, name))
+            self.db.commit()
+
+    def state(self, dir):
+        with self.lock:
+            row = self.db.execute('SELECT mtime, hash FROM dirs WHERE mirror = ? AND path = ?',
+                                  (self.id, dir)).fetchone()
+        return row and {'mtime': row[0], 'hash': row[1]}
+
+    def complete(self, dir, mtime, hash):
+        if self.readonly:
+            return
+        with self.lock:
+            self.db.execute('INSERT INTO journal (mirror, kind, path, mtime, hash) VALUES (?, ?, ?, ?, ?)',
+                            (self.id, 'complete', dir, mtime, hash))
+            self.db.commit()
+
+    def resumable(self, target):
+        with self.lock:
+            row = self.db.execute('SELECT id FROM mirrors WHERE target = ?', (target,)).fetchone()
+            if row is None or self.db.execute('SELECT 1 FROM journal WHERE mirror = ?', row).fetchone() is None:
+                return False
+            self.id = row[0]
+        return True
+
+    def startjournal(self):
+        if self.readonly:
+            return
+        with self.lock:
+            if self.db.execute('DELETE FROM journal WHERE mirror = ?', (self.id,)).rowcount:
+                log('Discarding the journal of an interrupted run, use --resume to continue one')
+            self.db.execute('INSERT INTO journal (mirror, kind, path, mtime, present) VALUES (?, ?, ?, ?, ?)',
+                            (self.id, 'scan', '', 0, 1))
+            self.db.commit()
+
+    def scanned(self, dir, children):
+        if self.readonly:
+            return
+        with self.lock:
+            self.db.executemany('INSERT INTO journal (mirror, kind, path, mtime, present) VALUES (?, ?, ?, ?, ?)',
+                                [(self.id, 'scan', child, mtime, exists) for child, mtime, exists in children])
+            self.db.execute('DELETE FROM journal WHERE mirror = ? AND kind = ? AND path = ?',
+                            (self.id, 'scan', dir))
+            self.db.commit()
+
+    def pending_scans(self):
+        with self.lock:
+            return [(path, mtime, bool(present)) for path, mtime, present in self.db.execute(
+                'SELECT path, mtime, present FROM journal WHERE mirror = ? AND kind = ?', (self.id, 'scan'))]
+
+    def queued(self, src, dst, size, key, mtime=None):
+        if self.readonly:
+            return
+        with self.lock:
+            self.db.execute('INSERT INTO journal (mirror, kind, path, name, src, dst, size, mtime) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                            (self.id, 'transfer', key[0], key[1], src, dst, size, mtime))
+            self.db.commit()
+
+    def transferred(self, dst):
+        """Drop the journal row of a finished transfer and only now record
+        the source mtime, so an update that never landed is done again"""
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime, path, name FROM journal WHERE mirror = ? AND kind = ? '
+                                  'AND dst = ?', (self.id, 'transfer', dst)).fetchone()
+            if row is not None and row[1] is not None:
+                self.db.execute('UPDATE files SET size = ?, mtime = ? WHERE mirror = ? AND dir = ? AND name = ?',
+                                (row[0], row[1], self.id, row[2], row[3]))
+            self.db.execute('DELETE FROM journal WHERE mirror = ? AND kind = ? AND dst = ?',
+                            (self.id, 'transfer', dst))
+            self.db.execute('DELETE FROM partials WHERE mirror = ? AND dst = ?', (self.id, dst))
+            self.db.commit()
+
+    def resumable_partial(self, dst, size, mtime):
+        """Whether the partial file of dst was started from this version of
+        the source, if not it is recorded as started from it now"""
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime FROM partials WHERE mirror = ? AND dst = ?',
+                                  (self.id, dst)).fetchone()
+            if row == (size, mtime):
+                return True
+            self.db.execute('INSERT OR REPLACE INTO partials (mirror, dst, size, mtime) VALUES (?, ?, ?, ?)',
+                            (self.id, dst, size, mtime))
+            self.db.commit()
+        return False
+
+    def pending_transfers(self):
+        with self.lock:
+            return [(src, dst, size, (path, name), mtime) for path, name, src, dst, size, mtime in self.db.execute(
+                'SELECT path, name, src, dst, size, mtime FROM journal WHERE mirror = ? AND kind = ?',
+                (self.id, 'transfer'))]
+
+    def incomplete(self, dir):
+        # Ancestors must not be pruned either, or the failure is never revisited
+        with self.lock:
+            while True:
+                self.failed.add(dir)
+                if not dir:
+                    break
+                dir = os.path.dirname(dir)
+
+    def subdirs(self, dir):
+        """Recorded direct subdirectories of dir with their mtimes"""
+        with self.lock:
+            rows = self.db.execute('SELECT path, mtime FROM dirs WHERE mirror = ? AND substr(path, 1, ?) = ? '
+                                   'AND instr(substr(path, ?), \'/\') = 0',
+                                   (self.id, len(dir) + 1, dir + '/', len(dir) + 2)).fetchall()
+        return [(path, mtime or 0) for path, mtime in rows]
+
+    def treestats(self, dir):
+        prefix = (len(dir) + 1, dir + '/')
+        with self.lock:
+            dirs = self.db.execute('SELECT count(*) FROM dirs WHERE mirror = ? AND substr(path, 1, ?) = ?',
+                                   (self.id,) + prefix).fetchone()[0]
+            files, size = self.db.execute('SELECT count(*), coalesce(sum(size), 0) FROM files '
+                                          'WHERE mirror = ? AND (dir = ? OR substr(dir, 1, ?) = ?)',
+                                          (self.id, dir) + prefix).fetchone()
+        return dirs, files, size
+
+    def verified(self):
+        with self.lock:
+            row = self.db.execute('SELECT coalesce(last_verified, 0) FROM mirrors WHERE id = ?',
+                                  (self.id,)).fetchone()
+        return row and row[0] or 0
+
+    def deletion(self, mode=None):
+        """How pruned directories are removed on this mirror, mode replaces
+        the stored setting when given"""
+        with self.lock:
+            if mode is not None and not self.readonly:
+                self.db.execute('UPDATE mirrors SET deletion = ? WHERE id = ?', (mode, self.id))
+                self.db.commit()
+            row = self.db.execute('SELECT deletion FROM mirrors WHERE id = ?', (self.id,)).fetchone()
+        return mode or row and row[0] or 'delete'
+
+    def listing(self, host, path):
+        with self.lock:
+            row = self.db.execute('SELECT fetched, mtimes, dirs, files FROM listings WHERE host = ? AND path = ?',
+                                  (host, path)).fetchone()
+        return row and (row[0], bool(row[1]), json.loads(row[2]), json.loads(row[3]))
+
+    def storelisting(self, host, path, entry):
+        if self.readonly:
+            return
+        fetched, mtimes, dirs, files = entry
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?, ?)',
+                            (host, path, fetched, mtimes, json.dumps(dirs), json.dumps(files)))
+            self.db.commit()
+
+    def droplistings(self, host, paths):
+        if self.readonly:
+            return
+        with self.lock:
+            self.db.executemany('DELETE FROM listings WHERE host = ? AND path = ?',
+                                [(host, path) for path in paths])
+            self.db.commit()
+
+    def removetree(self, dir):
+        if self.readonly:
+            return
+        with self.lock:
+            for table, column in (('files', 'dir'), ('dirs', 'path')):
+                self.db.execute('DELETE FROM %s WHERE mirror = ? AND (%s = ? OR substr(%s, 1, ?) = ?)'
+                                % (table, column, column), (self.id, dir, len(dir) + 1, dir + '/'))
+            self.db.commit()
+
+    def finish(self, full=False):
+        if self.readonly:
+            return
+        now = int(time.time())
+        with self.lock:
+            completed = self.db.execute('SELECT mtime, hash, mirror, path FROM journal '
+                                        'WHERE mirror = ? AND kind = ?', (self.id, 'complete')).fetchall()
+            self.db.executemany('UPDATE dirs SET mtime = ?, hash = ? WHERE mirror = ? AND path = ?',
+                                [row for row in completed if row[3] not in self.failed])
+            self.db.execute('DELETE FROM journal WHERE mirror = ?', (self.id,))
+            self.db.execute('UPDATE mirrors SET last_updated = ? WHERE id = ?', (now, self.id))
+            if full:
+                self.db.execute('UPDATE mirrors SET last_verified = ? WHERE id = ?', (now, self.id))
+            self.db.commit()
+
+    def record(self, bytes, seconds):
+        if self.readonly or not bytes:
+            return
+        with self.lock:
+            self.db.execute('INSERT INTO runs (mirror, finished, bytes, seconds) VALUES (?, ?, ?, ?)',
+                            (self.id, int(time.time()), bytes, seconds))
+            self.db.commit()
+
+    def throughput(self, runs=10):
+        with self.lock:
+            rows = self.db.execute('SELECT bytes, seconds FROM runs WHERE mirror = ? '
+                                   'ORDER BY finished DESC LIMIT ?', (self.id, runs)).fetchall()
+        seconds = sum(row[1] for row in rows)
+        if not seconds:
+            return None
+        return sum(row[0] for row in rows) / seconds
+
+    def describe(self, target):
+        with self.lock:
+            row = self.db.execute('SELECT id, source, last_updated FROM mirrors WHERE target = ?',
+                                  (target,)).fetchone()
+            if row is None:
+                return None
+            files, size = self.db.execute('SELECT count(*), coalesce(sum(size), 0) FROM files '
+                                          'WHERE mirror = ?', row[:1]).fetchone()
+        return {'source': row[1], 'last_updated': row[2], 'files': files, 'bytes': size}
+
+    def targets(self, source):
+        with self.lock:
+            return [row[0] for row in self.db.execute('SELECT target FROM mirrors WHERE source = ?',
+                                                      (source,))]
+
+    def close(self):
+        self.db.close()
 
-def strfbytes(value):
-    global unit
-    units = ['Bytes', 'KB', 'MB', 'GB', 'TB']
-    value = float(value)
-    for unit in units:
-        if value < 1024: break
-        value /= 1024
-    if unit == units[0]:
-        fmt = '%.0f %s'
-    else:
-        fmt = '%.2f %s'
-    return fmt % (value, unit)
+
+class mlsdLister:
+    """Directory listing with MLSD, exact UTC timestamps in one round-trip"""
+
+    command = 'MLSD'
+
+    def list(self, ftp, dir, skip_mtime=False):
+        dirs = {}
+        files = {}
+        for name, facts in ftp.mlsd(dir):
+            kind = facts.get('type', '').lower()
+            if kind not in ('dir', 'file'):
+                continue
+            if skip_mtime or 'modify' not in facts:
+                mtime = 0
+            else:
+                mtime = calendar.timegm(time.strptime(facts['modify'][:14], '%Y%m%d%H%M%S'))
+            if kind == 'dir':
+                dirs[name] = {'mtime': mtime}
+            else:
+                files[name] = {
+                    'size': int(facts.get('size', 0)),
+                    'mtime': mtime,
+                }
+        return dirs, files
+
+
+class unixLister:
+    """Directory listing parsed from unix style LIST output"""
+
+    command = 'LIST'
+
+    def list(self, ftp, dir, skip_mtime=False):
+        month_to_int = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4,
+                        'May': 5, 'Jun': 6, 'Jul': 7, 'Aug': 8, 'Sep': 9,
+                        'Oct': 10, 'Nov': 11, 'Dec': 12}
+        try:
+            buffer = []
+            ftp.dir('-a', dir, buffer.append)
+        except (ftplib.error_temp, ftplib.error_perm):
+            buffer = []
+            ftp.dir(dir, buffer.append)
+        dirs = {}
+        files = {}
+        for line in buffer:
+            cols = line.split(None, 8)
+            name = os.path.split(cols[8])[1]
+            if cols[0] == 'total' or name in ('.', '..'):
+                continue
+            if skip_mtime:
+                mtime = 0
+            else:
+                month = month_to_int[cols[5]]
+                day = int(cols[6])
+                if cols[7].find(':') == -1:
+                    year = int(cols[7])
+                    hour = minute = 0
+                else:
+                    year = datetime.date.today().year
+                    hour, minute = [int(s) for s in cols[7].split(':')]
+                mtime = datetime.datetime(year, month, day, hour, minute)
+                mtime = int(time.mktime(mtime.timetuple()))
+            if cols[0].startswith('d'):
+                dirs[name] = {'mtime': mtime}
+            else:
+                size = int(cols[4])
+                files[name] = {
+                    'size': size,
+                    'mtime': mtime,
+                }
+        return dirs, files
 
 
 class localHandler:
     """ Local file and directory functions"""
 
-    def __init__(self, ftp, root):
-        self.ftp = ftp
+    def __init__(self, pool, root):
+        self.pool = pool
         self.root = root
         self.host = ''
+        self.rest = None
+        self.segments = None
+        if globals['segments'] > 1 and not isinstance(pool, asyncPool):
+            self.segments = ThreadPoolExecutor(globals['segments'] * globals['jobs'], 'segment')
+
+    @property
+    def ftp(self):
+        return self.pool.get()
+
+    def supports_rest(self):
+        if self.rest is None:
+            try:
+                self.ftp.voidcmd('TYPE I')
+                self.ftp.sendcmd('REST 1')
+                self.ftp.sendcmd('REST 0')
+                self.rest = True
+            except (ftplib.error_temp, ftplib.error_perm, ftplib.error_reply):
+                log('--> Server does not support REST, segmented download disabled', 2)
+                self.rest = False
+        return self.rest
+
+    async def asupports_rest(self, ftp):
+        """supports_rest() on a session of a transfer coroutine"""
+        if self.rest is None:
+            try:
+                await ftp.command('TYPE I', '2')
+                await ftp.command('REST 1')
+                await ftp.command('REST 0')
+                self.rest = True
+            except (ftplib.error_temp, ftplib.error_perm, ftplib.error_reply):
+                log('--> Server does not support REST, segmented download disabled', 2)
+                self.rest = False
+        return self.rest
+
+    def startpart(self, dst, resume):
+        part = dst + '.part'
+        if not resume:
+            for path in (part, part + '.seg'):
+                if os.path.exists(path):
+                    os.remove(path)
+        return part
+
+    def segmented(self, size):
+        return globals['segments'] > 1 and size is not None and size >= globals['segment_size']
+
+    def resumable(self, part, size):
+        """Whether a partial file is there to resume, REST permitting"""
+        return size is not None and os.path.exists(part) and not os.path.exists(part + '.seg')
+
+    def resumeat(self, src, part, size):
+        offset = os.path.getsize(part)
+        if offset > size:
+            offset = 0
+        if offset:
+            log('--> Resume %s at %s' % (src, strfbytes(offset)), 2)
+        return offset
+
+    def startdigest(self, part, offset=0, segmented=False):
+        if not globals['checksum']:
+            return None
+        if segmented:
+            # Segments arrive out of order, so this one needs a second pass
+            return hashfile(newdigest(), part)
+        digest = newdigest()
+        if offset:
+            hashfile(digest, part, offset)
+        return digest
+
+    def endpart(self, src, part, size):
+        if size is not None and os.path.getsize(part) != size:
+            raise ftplib.error_proto('Size mismatch on %s, partial file kept' % src)
+
+    def storefile(self, src, dst, size=None, resume=True):
+        part = self.startpart(dst, resume)
+        if self.segmented(size) and self.supports_rest():
+            self.storesegmented(src, part, size)
+            digest = self.startdigest(part, segmented=True)
+        else:
+            offset = self.resumable(part, size) and self.supports_rest() and self.resumeat(src, part, size) or 0
+            digest = self.startdigest(part, offset)
+            if offset != size:
+                ftp = self.ftp
+                ftp.voidcmd('TYPE I')
+                fh = open(part, offset and 'ab' or 'wb')
+                conn = ftp.transfercmd('RETR %s' % src, offset or None)
+                try:
+                    receive(conn, fh, digest)
+                finally:
+                    conn.close()
+                    fh.close()
+                ftp.voidresp()
+        self.endpart(src, part, size)
+        digest = checkdigest(src, digest, digest is not None and self.pool.checksum(src) or None)
+        os.replace(part, dst)
+        return digest
 
-    def storefile(self, src, dst):
-        fh = open(dst, 'wb')
-        self.ftp.retrbinary('RETR %s' % src, fh.write)
+    async def astorefile(self, worker, src, dst, size=None, resume=True):
+        """storefile() as a coroutine on the sessions of worker"""
+        part = self.startpart(dst, resume)
+        ftp = await worker.session()
+        if self.segmented(size) and await self.asupports_rest(ftp):
+            await self.astoresegmented(worker, src, part, size)
+            digest = self.startdigest(part, segmented=True)
+        else:
+            offset = self.resumable(part, size) and await self.asupports_rest(ftp) \
+                and self.resumeat(src, part, size) or 0
+            digest = self.startdigest(part, offset)
+            if offset != size:
+                await ftp.command('TYPE I', '2')
+                with open(part, offset and 'ab' or 'wb') as fh:
+                    await ftp.retrieve('RETR %s' % src, fh, offset or None, digest)
+        self.endpart(src, part, size)
+        digest = checkdigest(src, digest, digest is not None and await ftp.checksum(src) or None)
+        os.replace(part, dst)
+        return digest
+
+    def checksum(self, path):
+        return None
+
+    def startsegments(self, src, part, size):
+        """Byte ranges of part still to fetch. Completed ones are journaled
+        next to the partial file, so an interrupted download only fetches
+        the missing segments again"""
+        journal = part + '.seg'
+        done = set()
+        if os.path.exists(part) and os.path.exists(journal) and os.path.getsize(part) == size:
+            done = set(int(line) for line in self.readlines(journal) if line)
+        else:
+            fh = open(part, 'wb')
+            fh.truncate(size)
+            fh.close()
+            self.storetext('', journal)
+        log('--> Retrieve %s in %i segments' % (src, globals['segments']), 2)
+        length = -(-size // globals['segments'])
+        return journal, [(offset, min(length, size - offset)) for offset in range(0, size, length)
+                         if offset not in done]
+
+    def storesegmented(self, src, part, size):
+        journal, segments = self.startsegments(src, part, size)
+        lock = threading.Lock()
+        futures = [self.segments.submit(self.storesegment, src, part, offset, length, journal, lock)
+                   for offset, length in segments]
+        for future in futures:
+            future.result()
+        os.remove(journal)
+
+    async def astoresegmented(self, worker, src, part, size):
+        journal, segments = self.startsegments(src, part, size)
+        # Every segment runs to its end before the first error is raised,
+        # so none is left writing into the partial file
+        results = await asyncio.gather(*[self.astoresegment(worker, index, src, part, offset, length, journal)
+                                         for index, (offset, length) in enumerate(segments)],
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        os.remove(journal)
+
+    async def astoresegment(self, worker, index, src, dst, offset, length, journal):
+        ftp = await worker.session(index)
+        await ftp.command('TYPE I', '2')
+        with open(dst, 'r+b') as fh:
+            fh.seek(offset)
+            remaining = await ftp.retrieve('RETR %s' % src, fh, offset, length=length)
+        try:
+            # Segments ending before EOF are cut off, which servers answer with 426
+            await ftp.command_done()
+        except (ftplib.error_temp, ftplib.error_perm):
+            pass
+        except ftplib.all_errors:
+            worker.discard(index)
+        if remaining:
+            raise ftplib.error_proto('Short read on %s at offset %i' % (src, offset + length - remaining))
+        fh = open(journal, 'a')
+        fh.write('%i\n' % offset)
         fh.close()
 
+    def storesegment(self, src, dst, offset, length, journal, lock):
+        ftp = self.ftp
+        ftp.voidcmd('TYPE I')
+        conn = ftp.transfercmd('RETR %s' % src, offset)
+        fh = open(dst, 'r+b')
+        fh.seek(offset)
+        try:
+            remaining = receive(conn, fh, length=length)
+        finally:
+            fh.close()
+            conn.close()
+        try:
+            # Segments ending before EOF are cut off, which servers answer with 426
+            ftp.voidresp()
+        except (ftplib.error_temp, ftplib.error_perm):
+            pass
+        except ftplib.all_errors:
+            self.pool.discard()
+        if remaining:
+            raise ftplib.error_proto('Short read on %s at offset %i' % (src, offset + length - remaining))
+        with lock:
+            fh = open(journal, 'a')
+            fh.write('%i\n' % offset)
+            fh.close()
+
     def storetext(self, text, dst):
         fh = open(dst, 'w')
         fh.write(text)
@@ -117,62 +2792,163 @@ class localHandler:
         return buffer
 
     def list(self, dir, skip_mtime=False):
-        dirs = []
+        dirs = {}
         files = {}
         for name in os.listdir(dir):
             path = os.path.join(dir, name)
+            if skip_mtime:
+                mtime = 0
+            else:
+                mtime = int(os.path.getmtime(path))
             if os.path.isdir(path):
-                dirs.append(name)
+                dirs[name] = {'mtime': mtime}
             else:
-                if skip_mtime:
-                    mtime = 0
-                else:
-                    mtime = int(os.path.getmtime(path))
                 files[name] = {
                     'size': os.path.getsize(path),
                     'mtime': mtime,
                 }
         return dirs, files
 
-    def makedir(self, path):
+    def makedir(self, path, counted=True):
         log('--> Create directory %s' % path, 2)
         os.mkdir(path)
-        globals['status']['dirs_created'] += 1
+        if counted:
+            count('dirs_created')
 
     def removefile(self, path):
         log('--> Remove file %s' % path, 2)
         os.remove(path)
-        globals['status']['files_removed'] += 1
+        count('files_removed')
+
+    def removefiles(self, paths):
+        self.removeeach(self.removefile, paths)
+
+    def removedirs(self, paths):
+        self.removeeach(self.removeemptydir, paths)
+
+    def removeemptydir(self, path):
+        log('--> Remove directory %s' % path, 2)
+        os.rmdir(path)
+        count('dirs_removed')
+
+    def removeeach(self, method, paths):
+        """Like remoteHandler.pipeline, every path is tried and the first
+        error raised at the end"""
+        error = None
+        while paths:
+            try:
+                method(paths[0])
+            except OSError as err:
+                log('--> Removal of %s failed: %s' % (paths[0], err))
+                error = error or err
+            del paths[0]
+        if error is not None:
+            raise error
 
     def removedir(self, dir):
-        for name in os.listdir(dir):
-            path = os.path.join(dir, name)
-            if os.path.isdir(path):
-                self.removedir(path)
-            else:
-                self.removefile(path)
-        log('--> Remove directory %s' % dir, 2)
-        os.rmdir(dir)
-        globals['status']['dirs_removed'] += 1
+        removetree(self, dir)
+
+    def rename(self, src, dst):
+        os.rename(src, dst)
 
 
 class remoteHandler:
     """Remote file and directory functions"""
 
-    def __init__(self, ftp, root):
-        self.ftp = ftp
+    def __init__(self, pool, root):
+        self.pool = pool
         self.root = root
-        self.host = ftp.host
+        self.host = pool.host
+        self.lister = None
+        # Listing cache key, the same host can serve several transports
+        self.address = '%s:%i' % (pool.host, pool.port)
 
-    def storefile(self, src, dst):
-        fh = open(src)
-        self.ftp.storbinary('STOR %s' % dst, fh)
-        fh.close()
+    @property
+    def ftp(self):
+        return self.pool.get()
+
+    def storefile(self, src, dst, size=None, resume=True):
+        part = dst + '.part'
+        size = os.path.getsize(src)
+        self.uncache(dst)
+        ftp = self.ftp
+        ftp.voidcmd('TYPE I')
+        try:
+            offset = resume and ftp.size(part) or 0
+        except ftplib.error_perm:
+            offset = 0
+        if offset > size:
+            ftp.delete(part)
+            offset = 0
+        digest = None
+        if globals['checksum']:
+            digest = hashfile(newdigest(), src, offset)
+        if offset:
+            log('--> Resume %s at %s' % (dst, strfbytes(offset)), 2)
+        fh = open(src, 'rb')
+        conn = ftp.transfercmd('%s %s' % (offset and 'APPE' or 'STOR', part))
+        try:
+            send(conn, fh, digest, offset)
+        finally:
+            conn.close()
+            fh.close()
+        ftp.voidresp()
+        if ftp.size(part) != size:
+            raise ftplib.error_proto('Size mismatch on %s, partial file kept' % dst)
+        digest = checkdigest(dst, digest, digest is not None and self.pool.checksum(part) or None)
+        try:
+            ftp.rename(part, dst)
+        except ftplib.error_perm:
+            ftp.delete(dst)
+            ftp.rename(part, dst)
+        self.uncache(dst)
+        return digest
+
+    async def astorefile(self, worker, src, dst, size=None, resume=True):
+        """storefile() as a coroutine on the session of worker"""
+        part = dst + '.part'
+        size = os.path.getsize(src)
+        self.uncache(dst)
+        ftp = await worker.session()
+        await ftp.command('TYPE I', '2')
+        try:
+            offset = resume and await ftp.asize(part) or 0
+        except ftplib.error_perm:
+            offset = 0
+        if offset > size:
+            await ftp.adelete(part)
+            offset = 0
+        digest = None
+        if globals['checksum']:
+            digest = hashfile(newdigest(), src, offset)
+        if offset:
+            log('--> Resume %s at %s' % (dst, strfbytes(offset)), 2)
+        with open(src, 'rb') as fh:
+            await ftp.store('%s %s' % (offset and 'APPE' or 'STOR', part), fh, offset, digest)
+        if await ftp.asize(part) != size:
+            raise ftplib.error_proto('Size mismatch on %s, partial file kept' % dst)
+        digest = checkdigest(dst, digest, digest is not None and await ftp.checksum(part) or None)
+        try:
+            await ftp.arename(part, dst)
+        except ftplib.error_perm:
+            await ftp.adelete(dst)
+            await ftp.arename(part, dst)
+        self.uncache(dst)
+        return digest
+
+    def checksum(self, path):
+        return self.pool.checksum(path)
+
+    def uncache(self, *paths):
+        if globals['cache'] is not None:
+            for path in paths:
+                globals['cache'].invalidate(self.address, path)
 
     def storetext(self, text, dst):
-        fh = StringIO.StringIO(text)
+        fh = BytesIO(text.encode('utf-8'))
         self.ftp.storlines('STOR %s' % dst, fh)
         fh.close()
+        self.uncache(dst)
 
     def readlines(self, path):
         buffer = []
@@ -180,180 +2956,421 @@ class remoteHandler:
         return buffer
 
     def list(self, dir, skip_mtime=False):
-        month_to_int = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4,
-                        'May': 5, 'Jun': 6, 'Jul': 7, 'Aug': 8, 'Sep': 9,
-                        'Oct': 10, 'Nov': 11, 'Dec': 12}
-        try:
-            buffer = []
-            self.ftp.dir('-a', dir, buffer.append)
-        except ftplib.error_temp:
-            buffer = []
-            self.ftp.dir(dir, buffer.append)
-        dirs = []
-        files = {}
-        for line in buffer:
-            cols = line.split(None, 8)
-            name = os.path.split(cols[8])[1]
-            if cols[0] == 'total' or name in ('.', '..'):
-                continue
-            if cols[0].startswith('d'):
-                dirs.append(name)
+        if self.lister is None:
+            if globals['lister'] == 'mlsd' or \
+                    (globals['lister'] == 'auto' and 'MLST' in self.pool.features()):
+                self.lister = mlsdLister()
             else:
-                if skip_mtime:
-                    mtime = 0
-                else:
-                    month = month_to_int[cols[5]]
-                    day = int(cols[6])
-                    if cols[7].find(':') == -1:
-                        year = int(cols[7])
-                        hour = minute = 0
-                    else:
-                        year = datetime.date.today().year
-                        hour, minute = [int(s) for s in cols[7].split(':')]
-                    mtime = datetime.datetime(year, month, day, hour, minute)
-                    mtime = int(time.mktime(mtime.timetuple()))
-                size = int(cols[4])
-                files[name] = {
-                    'size': size,
-                    'mtime': mtime,
-                }
-        return dirs, files
+                self.lister = unixLister()
+            log('--> Listing directories with %s' % self.lister.command, 2)
+        cache = globals['cache']
+        listing = cache is not None and cache.get(self.address, dir, skip_mtime)
+        if not listing:
+            started = time.time()
+            listing = self.lister.list(self.ftp, dir, skip_mtime)
+            observe('LIST', time.time() - started)
+            if cache is not None:
+                cache.put(self.address, dir, skip_mtime, listing)
+        return listing
 
-    def makedir(self, path):
+    def makedir(self, path, counted=True):
         log('--> Create directory %s' % path, 2)
         self.ftp.mkd(path)
-        globals['status']['dirs_created'] += 1
+        self.uncache(path)
+        if counted:
+            count('dirs_created')
 
     def removefile(self, path):
         log('--> Remove file %s' % path, 2)
         self.ftp.delete(path)
-        globals['status']['files_removed'] += 1
+        self.uncache(path)
+        count('files_removed')
+
+    def removefiles(self, paths):
+        self.pipeline('DELE', paths, 'Remove file', 'files_removed')
+
+    def removedirs(self, paths):
+        self.pipeline('RMD', paths, 'Remove directory', 'dirs_removed')
+
+    def pipeline(self, command, paths, action, counter):
+        """Send one command per path without waiting, then collect the
+        replies in order. Confirmed paths are dropped from the list, so a
+        retry on a new connection only repeats the rest"""
+        ftp = self.ftp
+        for path in paths:
+            ftp.putcmd('%s %s' % (command, path))
+        error = None
+        while paths:
+            self.uncache(paths[0])
+            try:
+                ftp.voidresp()
+                log('--> %s %s' % (action, paths[0]), 2)
+                count(counter)
+            except ftplib.error_perm as err:
+                log('--> %s %s failed: %s' % (action, paths[0], err))
+                error = error or err
+            del paths[0]
+        if error is not None:
+            raise error
 
     def removedir(self, path):
-        dirs, files = self.list(path)
-        for dir in dirs:
-            self.removedir(os.path.join(path, dir))
-        for file in files:
-            self.removefile(os.path.join(path, file))
-        if path == '/':
-            return
-        log('--> Remove directory %s' % path, 2)
-        self.ftp.rmd(path)
-        globals['status']['dirs_removed'] += 1
+        removetree(self, path, path == '/')
+
+    def rename(self, src, dst):
+        self.ftp.rename(src, dst)
+        self.uncache(src, dst)
+
+
+def checkmirror(src, dst, manifest, dst_dirs, dst_files):
+    source = src.host + os.path.normpath(src.root)
+    target = dst.host + os.path.normpath(dst.root)
+    mirror_path = manifest.source(target)
+    if mirror_path is None and '.sfmstat' in dst_files:
+        sfmstat = dst.readlines(os.path.join(dst.root, '.sfmstat'))
+        mirror_path = sfmstat[0].split(None, 1)[1]
+    if globals['verbose']:
+        abort = False
+    else:
+        abort = True
+    if globals['plan'] and mirror_path is not None and mirror_path != source:
+        log('Mirror mismatch! %s already contains another mirror of %s' % (target, mirror_path))
+    elif mirror_path is None:
+        if globals['plan']:
+            pass
+        elif dst_dirs or dst_files:
+            log('New mirror, but target directory not empty!', abort=abort)
+            result = input('Do you really want to replace this directory? [y|n]: ')
+            if result.lower() not in ('y', 'yes'):
+                log('Aborted', abort=True)
+    elif mirror_path != source:
+        error = 'Mirror mismatch!\n%s already contains another mirror of %s' % (target, mirror_path)
+        log(error, abort=abort)
+        result = input('Do you really want to replace this mirror? [y|n]: ')
+        if result.lower() not in ('y', 'yes'):
+            log('Aborted', abort=True)
+        manifest.forget(target)
+    manifest.open(target, source)
+    usedeletion(dst, manifest)
+    if not globals['resume']:
+        manifest.startjournal()
+    if globals['incremental'] and time.time() - manifest.verified() > globals['verify_interval']:
+        log('Running full verify pass')
+        globals['incremental'] = False
+
+
+def usedeletion(dst, manifest):
+    mode = globals['deletion'] or manifest.deletion()
+    trash = mode.startswith('trash:') and os.path.normpath(mode[6:])
+    if trash and (trash + '/').startswith(os.path.normpath(dst.root).rstrip('/') + '/'):
+        log('The trash %s must be outside of the mirror %s' % (trash, dst.root), abort=True)
+    if trash and not globals['plan']:
+        try:
+            retry(dst.pool, 'Listing of %s' % trash, dst.list, trash, True)
+        except (ftplib.error_perm, OSError):
+            log('The trash directory %s does not exist' % trash, abort=True)
+    globals['deletion'] = manifest.deletion(mode)
 
 
-def mirror(src, dst, subdir=''):
+def resumable(src, dst, manifest):
+    if not globals['resume']:
+        return False
+    target = dst.host + os.path.normpath(dst.root)
+    if manifest.resumable(target) and manifest.source(target) == src.host + os.path.normpath(src.root):
+        usedeletion(dst, manifest)
+        return True
+    log('Nothing to resume for %s, starting a new run' % target)
+    globals['resume'] = False
+    return False
+
+
+def mirror(src, dst, plan, manifest, resume=False):
+    # Directories are listed breadth-first on the scanner connections while
+    # the main thread compares finished listings and queues their transfers
+    # A directory that fails is reported and skipped, the rest of the tree goes on
+    scanner = ThreadPoolExecutor(globals['scanners'], 'scan')
+    if resume:
+        scans = manifest.pending_scans()
+        log('Resuming %i directories left to scan' % len(scans))
+        # A directory missing when it was queued was created by the
+        # interrupted run, so whether the target exists is looked up again
+        pending = dict((scanner.submit(scan, src, dst, manifest, subdir, mtime, exists or None), subdir)
+                       for subdir, mtime, exists in scans)
+        plan.resume()
+    else:
+        pending = {scanner.submit(scan, src, dst, manifest, '', 0, True): ''}
+    try:
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                subdir = pending.pop(future)
+                try:
+                    children = sync(src, dst, plan, manifest, future.result())
+                except ftplib.all_errors as err:
+                    if not subdir:
+                        raise
+                    fail('Sync of %s' % os.path.join(src.root, subdir), err)
+                    manifest.incomplete(subdir)
+                    manifest.scanned(subdir, [])
+                    continue
+                manifest.scanned(subdir, children)
+                for child, mtime, exists in children:
+                    pending[scanner.submit(scan, src, dst, manifest, child, mtime, exists)] = child
+    finally:
+        scanner.shutdown(wait=True, cancel_futures=True)
+
+
+def scan(src, dst, manifest, subdir, mtime, exists):
     src_path = os.path.normpath('%s/%s' % (src.root, subdir))
     dst_path = os.path.normpath('%s/%s' % (dst.root, subdir))
     log('Working on %s%s' % (src.host, src_path))
 
-    src_dirs, src_files = src.list(src_path)
+    src_dirs, src_files = retry(src.pool, 'Listing of %s' % src_path, src.list, src_path)
     if '.sfmstat' in src_files:
         del src_files['.sfmstat']
+    filters = globals['filters']
+    excluded = filters is not None and filters.apply(subdir, src_dirs, src_files) or []
+
+    digest = listinghash(src_dirs, src_files)
+    state = subdir and exists and globals['incremental'] and manifest.state(subdir)
+    missing = False
+    if state and state['hash'] == digest:
+        log('--> Listing unchanged, skip comparison of %s' % dst_path, 2)
+        dst_dirs = dst_files = None
+    elif exists is not False:
+        try:
+            dst_dirs, dst_files = retry(dst.pool, 'Listing of %s' % dst_path, dst.list, dst_path, True)
+        except (ftplib.error_perm, FileNotFoundError):
+            if exists:
+                raise
+            missing = True
+            dst_dirs, dst_files = {}, {}
+    else:
+        dst_dirs, dst_files = {}, {}
+    if filters is not None and dst_files is not None:
+        # Whatever the filters hide stays untouched in the target
+        filters.apply(subdir, dst_dirs, dst_files, limits=False)
+        for name, size, is_dir in excluded:
+            (dst_dirs if is_dir else dst_files).pop(name, None)
+    return {
+        'subdir': subdir,
+        'mtime': mtime,
+        'missing': missing,
+        'digest': digest,
+        'excluded': excluded,
+        'src_dirs': src_dirs,
+        'src_files': src_files,
+        'dst_dirs': dst_dirs,
+        'dst_files': dst_files,
+    }
 
-    globals['status']['dirs_total'] += len(src_dirs)
-    globals['status']['files_total'] += len(src_files)
 
-    dst_dirs, dst_files = dst.list(dst_path, True)
-    if '.sfmstat' in dst_files:
-        sfmstat = dst.readlines(os.path.join(dst_path, '.sfmstat'))
-        del dst_files['.sfmstat']
+def sync(src, dst, plan, manifest, listing):
+    subdir = listing['subdir']
+    src_dirs = listing['src_dirs']
+    src_files = listing['src_files']
+    src_path = os.path.normpath('%s/%s' % (src.root, subdir))
+    dst_path = os.path.normpath('%s/%s' % (dst.root, subdir))
+
+    if listing['missing']:
+        plan.mkdir(dst_path)
+    count('dirs_total', len(src_dirs))
+    count('files_total', len(src_files))
+    for name, size, is_dir in listing['excluded']:
+        log('--> Exclude %s%s' % (os.path.join(src_path, name), is_dir and '/' or ''), 2)
+        plan.record('exclude', os.path.join(dst_path, name), size)
+        count(is_dir and 'dirs_excluded' or 'files_excluded')
+        count('bytes_excluded', size)
+
+    if listing['dst_files'] is None:
+        count('bytes_total', sum(file['size'] for file in src_files.values()))
+        dst_dirs = src_dirs
     else:
-        if dst_path == dst.root and (dst_dirs or dst_files):
-            if globals['verbose']:
-                abort = False
-            else:
-                abort = True
-            log('New mirror, but target directory not empty!', abort=abort)
-            result = raw_input('Do you really want to replace this directory? [y|n]: ')
-            if result.lower() not in ('y', 'yes'):
-                log('Aborted', abort=True)
-        sfmstat = ['0 %s%s' % (src.host, src_path)]
+        dst_dirs = compare(src, dst, plan, manifest, subdir, src_dirs, src_files,
+                           listing['dst_dirs'], listing['dst_files'])
 
-    last_updated, mirror_path = sfmstat[0].split(None, 1)
-    if mirror_path != (src.host + src_path):
-        if globals['verbose']:
-            abort = False
-        else:
-            abort = True
-        error = 'Mirror mismatch!\n%s already contains another mirror of %s' % (dst_path, mirror_path)
-        log(error, abort=abort)
-        result = raw_input('Do you really want to replace this mirror? [y|n]: ')
-        if result.lower() not in ('y', 'yes'):
-            log('Aborted', abort=True)
-        sfmstat = ['0 %s%s' % (src.host, src_path)]
+    children = []
+    for dir in src_dirs:
+        exists = dir in dst_dirs
+        if not exists:
+            plan.mkdir(os.path.join(dst_path, dir))
+        child = os.path.join(subdir, dir)
+        child_mtime = src_dirs[dir]['mtime']
+        state = globals['incremental'] and exists and child_mtime and manifest.state(child)
+        if state and state['hash'] and state['mtime'] == child_mtime:
+            log('--> Directory unchanged, skip %s' % os.path.join(src_path, dir), 2)
+            files = manifest.files(child)
+            subdirs = manifest.subdirs(child)
+            count('dirs_skipped')
+            count('dirs_total', len(subdirs))
+            count('files_total', len(files))
+            count('bytes_total', sum(file['size'] for file in files.values()))
+            # Changes further down do not touch the mtime of this directory,
+            # so its subdirectories are still looked at, their targets included
+            children.extend((path, mtime, None) for path, mtime in subdirs)
+            continue
+        children.append((child, child_mtime, exists))
+    manifest.complete(subdir, listing['mtime'], listing['digest'])
+    return children
 
-    for line in sfmstat[1:]:
-        mtime, file = line.split(None, 1)
-        if file in dst_files:
-            dst_files[file]['mtime'] = int(mtime)
+
+def compare(src, dst, plan, manifest, subdir, src_dirs, src_files, dst_dirs, dst_files):
+    src_path = os.path.normpath('%s/%s' % (src.root, subdir))
+    dst_path = os.path.normpath('%s/%s' % (dst.root, subdir))
+
+    # Source files named like partials are mirrored as they are
+    partials = [file for file in dst_files if partial(file) and file not in src_files]
+    for file in partials:
+        if file[:file.rindex('.part')] not in src_files:
+            plan.remove(os.path.join(dst_path, file), dst_files[file]['size'])
+        del dst_files[file]
+    if not subdir:
+        checkmirror(src, dst, manifest, dst_dirs, dst_files)
+
+    stored = manifest.files(subdir)
+    if '.sfmstat' in dst_files:
+        del dst_files['.sfmstat']
+        if not manifest.known(subdir):
+            # Mirrors created before the manifest keep their state in .sfmstat files
+            log('--> Import %s' % os.path.join(dst_path, '.sfmstat'), 2)
+            for line in dst.readlines(os.path.join(dst_path, '.sfmstat'))[1:]:
+                mtime, file = line.split(None, 1)
+                stored[file] = {'mtime': int(mtime)}
+
+    for file in dst_files:
+        if file in stored:
+            dst_files[file]['mtime'] = stored[file]['mtime']
 
     for dir in dst_dirs:
         if dir not in src_dirs:
             path = os.path.join(dst_path, dir)
-            log('-> Remove directory %s' % path)
-            dst.removedir(path)
+            plan.rmdir(path, manifest.treestats(os.path.join(subdir, dir))[2])
+            manifest.removetree(os.path.join(subdir, dir))
 
     for file in dst_files:
         if file not in src_files:
-            dst_file = os.path.join(dst_path, file)
-            log('-> Remove file %s: %s' % (dst_file, strfbytes(dst_files[file]['size'])))
-            dst.removefile(dst_file)
+            plan.remove(os.path.join(dst_path, file), dst_files[file]['size'])
+    plan.flush()
 
-    newstat = ['%i %s%s' % (int(time.time()), src.host, src_path)]
+    changed = []
     for file in src_files:
         if file not in dst_files or src_files[file]['mtime'] > dst_files[file]['mtime'] \
                 or src_files[file]['size'] != dst_files[file]['size']:
-            src_file = os.path.join(src_path, file)
-            dst_file = os.path.join(dst_path, file)
-            if file in dst_files:
-                log('-> Update file %s: %s' % (dst_file, strfbytes(src_files[file]['size'])))
-                globals['status']['files_updated'] += 1
-            else:
-                log('-> Create file %s: %s' % (dst_file, strfbytes(src_files[file]['size'])))
-                globals['status']['files_created'] += 1
-            dst.storefile(src_file, dst_file)
-            globals['status']['bytes_transfered'] += src_files[file]['size']
-        globals['status']['bytes_total'] += src_files[file]['size']
-        newstat.append('%i %s' % (src_files[file]['mtime'], file))
-    dst.storetext('\n'.join(newstat), os.path.join(dst_path, '.sfmstat'))
+            changed.append(file)
+        if globals['checksum'] and file in dst_files \
+                and src_files[file]['size'] == dst_files[file]['size'] \
+                and (stored.get(file, {}).get('checksum') or '').startswith(globals['checksum'] + ':'):
+            verified = verify(src, dst, os.path.join(src_path, file), os.path.join(dst_path, file),
+                              stored[file]['checksum'])
+            if verified:
+                src_files[file]['checksum'] = stored[file]['checksum']
+                if file in changed:
+                    changed.remove(file)
+            elif verified is False and file not in changed:
+                changed.append(file)
+        count('bytes_total', src_files[file]['size'])
+    # Stored before queueing, so digests of finished transfers are not reset.
+    # Changed files keep mtime 0 until transferred() records their new one,
+    # transfers resumed from the journal keep whatever they recorded so far
+    recorded = dict(src_files)
+    for file in changed:
+        resumed = os.path.join(dst_path, file) in plan.resumed
+        recorded[file] = dict(src_files[file], mtime=None if resumed else 0)
+    manifest.update(subdir, recorded)
+    for file in changed:
+        plan.transfer(os.path.join(src_path, file), os.path.join(dst_path, file),
+                      src_files[file]['size'], file in dst_files, (subdir, file), src_files[file]['mtime'])
+    return dst_dirs
 
-    for dir in src_dirs:
-        if dir not in dst_dirs:
-            dst_dir = os.path.join(dst_path, dir)
-            log('-> Create directory %s' % dst_dir)
-            dst.makedir(dst_dir)
-        mirror(src, dst, os.path.join(subdir, dir))
 
+def verify(src, dst, src_file, dst_file, cached):
+    """Compare the cached digest with whatever the servers can hash for us;
+    True when a digest matched and none differed, None when neither side
+    could hash"""
+    matched = None
+    for handler, path in ((src, src_file), (dst, dst_file)):
+        digest = handler.checksum(path)
+        if digest is not None and digest != cached:
+            log('--> Checksum changed on %s%s' % (handler.host, path), 2)
+            return False
+        if digest is not None:
+            matched = True
+    return matched
 
-def info(remote):
-    try:
-        sfmstat = remote.readlines(os.path.join(remote.root, '.sfmstat'))
-    except ftplib.error_perm as err:
-        if not err[0].startswith('550'):
-            log(err, abort=True)
-        sfmstat = None
+
+def info(remote, manifest):
+    target = remote.host + remote.root
+    described = manifest.describe(target)
     print()
-    if sfmstat:
-        last_updated, mirror_path = sfmstat[0].split(None, 1)
-        last_updated = datetime.datetime.fromtimestamp(float(last_updated))
-        print('Mirror of', mirror_path)
+    if described:
+        last_updated = datetime.datetime.fromtimestamp(described['last_updated'])
+        print('Mirror of', described['source'])
         print(last_updated.strftime('Last updated on %A, %d. %B %Y at %H:%M:%S'))
+        print('%i files, %s' % (described['files'], strfbytes(described['bytes'])))
     else:
-        print('No mirror recognized')
+        try:
+            sfmstat = remote.readlines(os.path.join(remote.root, '.sfmstat'))
+        except ftplib.error_perm as err:
+            if not str(err).startswith('550'):
+                log(err, abort=True)
+            sfmstat = None
+        if sfmstat:
+            last_updated, mirror_path = sfmstat[0].split(None, 1)
+            last_updated = datetime.datetime.fromtimestamp(float(last_updated))
+            print('Mirror of', mirror_path)
+            print(last_updated.strftime('Last updated on %A, %d. %B %Y at %H:%M:%S'))
+        else:
+            print('No mirror recognized')
+    for mirror_path in manifest.targets(target):
+        print('Mirrored to', mirror_path or '/')
     print()
     print('Content of %s%s:' % (remote.host, remote.root))
-    remote.ftp.dir(remote.root)
+    dirs, files = remote.list(remote.root)
+    for name in sorted(dirs):
+        print('%-40s%20s  %s' % (name + '/', '', strftime(dirs[name]['mtime'])))
+    for name in sorted(files):
+        print('%-40s%20s  %s' % (name, strfbytes(files[name]['size']), strftime(files[name]['mtime'])))
     print()
 
 
-def remove(remote):
+def remove(remote, manifest):
     if globals['verbose']:
-        info(remote)
-        result = raw_input('Do you really want to remove this directory? [y|n]: ')
+        info(remote, manifest)
+        result = input('Do you really want to remove this directory? [y|n]: ')
         if result.lower() not in ('y', 'yes'):
             log('Aborted', abort=True)
     remote.removedir(remote.root)
+    manifest.forget(remote.host + remote.root)
+
+
+def summarize_plan(plan, manifest):
+    rate = manifest.throughput()
+    size = sum(plan.totals.get(action, {'bytes': 0})['bytes'] for action in ('create', 'update'))
+    estimate = rate and size / rate
+    plan.write(globals['plan'], estimate)
+    log('Plan written to %s' % globals['plan'])
+    print()
+    print('=' * 60)
+    print('Plan Summary')
+    print('=' * 60)
+    for action in ('mkdir', 'rmdir', 'create', 'update', 'remove'):
+        totals = plan.totals.get(action, {'count': 0, 'bytes': 0})
+        print('%-30s%30s' % ('%s (%i)' % (action, totals['count']), strfbytes(totals['bytes'])))
+    print()
+    print('%-30s%30s' % ('Bytes to transfer', strfbytes(size)))
+    if globals['filters'] is not None:
+        totals = plan.totals.get('exclude', {'count': 0, 'bytes': 0})
+        print('%-30s%30s' % ('Excluded by filters (%i)' % totals['count'], strfbytes(totals['bytes'])))
+    if estimate is None:
+        print('%-30s%30s' % ('Estimated duration', 'unknown'))
+    else:
+        print('%-30s%30s' % ('Measured throughput', strfbytes(rate) + '/s'))
+        print('%-30s%30s' % ('Estimated duration', datetime.timedelta(seconds=int(estimate))))
+    print('=' * 60)
+    print()
+
+
+# Port used when the hostname does not give one
+default_ports = {'ftp': 21, 'ftps': 21, 'sftp': 22, 'http': 80, 'https': 443, 'file': 0}
 
 
 def main():
@@ -362,12 +3379,49 @@ def main():
     password = ''
     account = ''
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'vqu:p:a:')
+        opts, args = getopt.getopt(sys.argv[1:], 'vqj:w:s:S:B:L:b:m:D:C:PiF:c:r:R:I:X:u:p:a:',
+                                   ['plan=', 'resume', 'events=', 'metrics=',
+                                    'min-size=', 'max-size=', 'newer-than=', 'older-than='])
     except getopt.GetoptError as msg:
         log('%s\n%s' % (msg, __doc__), abort=True)
     for opt, val in opts:
         if opt == '-v': globals['verbose'] += 1
         if opt == '-q': globals['verbose'] = 0
+        if opt == '-j': globals['jobs'] = max(1, int(val))
+        if opt == '-w': globals['scanners'] = max(1, int(val))
+        if opt == '-s': globals['segments'] = max(1, int(val))
+        if opt == '-S': globals['segment_size'] = strtobytes(val)
+        if opt == '-B': globals['blocksize'] = max(4096, strtobytes(val))
+        if opt == '-L': globals['lister'] = val
+        if opt == '-b': globals['backend'] = val
+        if opt == '-m': globals['manifest'] = os.path.abspath(val)
+        if opt == '-D': globals['deletion'] = val
+        if opt == '-C': globals['cache_ttl'] = max(0.0, float(val))
+        if opt == '-P': globals['cache_persist'] = True
+        if opt == '-i': globals['incremental'] = True
+        if opt == '-F': globals['verify_interval'] = float(val) * 86400
+        if opt == '--plan': globals['plan'] = os.path.abspath(val)
+        if opt == '--resume': globals['resume'] = True
+        if opt == '--events': globals['events'] = os.path.abspath(val)
+        if opt == '--metrics': globals['metrics_port'] = int(val)
+        if opt == '-c': globals['checksum'] = val.lower()
+        if opt == '-R': globals['retries'] = max(0, int(val))
+        if opt in ('-I', '-X', '--min-size', '--max-size', '--newer-than', '--older-than'):
+            filters = globals['filters'] = globals['filters'] or filterRules()
+            try:
+                if opt == '-I': filters.include(val)
+                if opt == '-X': filters.exclude(val)
+                if opt == '--min-size': filters.min_size = strtobytes(val)
+                if opt == '--max-size': filters.max_size = strtobytes(val)
+                if opt == '--newer-than': filters.newer = age(val)
+                if opt == '--older-than': filters.older = age(val)
+            except (ValueError, re.error) as err:
+                log('Invalid filter %s %s: %s\n%s' % (opt, val, err, __doc__), abort=True)
+        if opt == '-r':
+            try:
+                globals['limiter'] = rateLimiter(val)
+            except ValueError:
+                log('Invalid rate schedule: %s\n%s' % (val, __doc__), abort=True)
         if opt == '-u': username = val
         if opt == '-p': password = val
         if opt == '-a': account = val
@@ -379,15 +3433,39 @@ def main():
     if action not in ('store', 'retrieve', 'remove', 'info'):
         log('Unknown action: %s\n%s' % (action, __doc__), abort=True)
 
+    if globals['lister'] not in ('auto', 'mlsd', 'list'):
+        log('Unknown lister: %s\n%s' % (globals['lister'], __doc__), abort=True)
+
+    if globals['deletion'] not in (None, 'delete', 'rename') and not globals['deletion'].startswith('trash:/'):
+        log('Unknown deletion mode: %s\n%s' % (globals['deletion'], __doc__), abort=True)
+
+    if globals['cache_persist'] and not globals['cache_ttl']:
+        log('-P needs a cache ttl (-C)\n%s' % __doc__, abort=True)
+
+    if globals['backend'] not in ('ftplib', 'asyncio'):
+        log('Unknown backend: %s\n%s' % (globals['backend'], __doc__), abort=True)
+
+    if globals['checksum'] not in (None,) + tuple(connectionPool.hash_names):
+        log('Unknown checksum algorithm: %s\n%s' % (globals['checksum'], __doc__), abort=True)
+
     if len(args) == 1:
         log('Missing hostname\n' + __doc__, abort=True)
 
-    args[1] = args[1].split(':')
-    host = args[1][0]
-    if len(args[1]) == 1:
-        port = 21
-    else:
-        port = int(args[1][1])
+    scheme, _, address = args[1].rpartition('://')
+    scheme = scheme.lower() or 'ftp'
+    if scheme not in default_ports:
+        log('Unknown transport: %s\n%s' % (scheme, __doc__), abort=True)
+    host, _, port = address.partition(':')
+    port = int(port or default_ports[scheme])
+
+    if scheme == 'sftp' and paramiko is None:
+        log('The sftp transport needs the paramiko module', abort=True)
+
+    if scheme in ('http', 'https') and action not in ('retrieve', 'info'):
+        log('%s sources can only be retrieved from' % scheme, abort=True)
+
+    if globals['backend'] == 'asyncio' and scheme != 'ftp':
+        log('The asyncio backend only speaks plain ftp', abort=True)
 
     remotedir = '/'
     if len(args) > 2:
@@ -406,40 +3484,80 @@ def main():
     if len(args) > 4:
         log('Too many arguments\n%s' % __doc__, abort=True)
 
+    if globals['plan'] and action not in ('store', 'retrieve'):
+        log('--plan only applies to store and retrieve\n%s' % __doc__, abort=True)
+
+    if globals['resume'] and (globals['plan'] or action not in ('store', 'retrieve')):
+        log('--resume only applies to store and retrieve\n%s' % __doc__, abort=True)
+
     if not username:
         username = 'anonymous'
     elif not password and globals['verbose']:
         password = getpass.getpass('FTP Password: ')
 
-    ftp = ftplib.FTP(timeout=300)
-    if globals['verbose'] > 2:
-        ftp.set_debuglevel(globals['verbose'] - 2)
-    ftp.connect(host, port)
-    ftp.login(username, password, account)
+    if globals['backend'] == 'asyncio':
+        pool = asyncPool(host, port, username, password, account)
+    elif scheme == 'ftps':
+        pool = tlsPool(host, port, username, password, account)
+    elif scheme != 'ftp':
+        pool = transportPool(scheme, host, port, username, password, account)
+    else:
+        pool = connectionPool(host, port, username, password, account)
+    ftp = pool.get()
     try:
         ftp.cwd(remotedir)
     except ftplib.error_perm as err:
-        if err[0].startswith('550'):
+        if str(err).startswith('550'):
             log('Remote Dir does not exist: %s' % remotedir, abort=True)
         else:
             raise
     ftp.cwd('/')
+    pool.cwd = '/'
 
-    local = localHandler(ftp, localdir)
-    remote = remoteHandler(ftp, remotedir)
-
-    if action == 'store':
-        mirror(local, remote)
-    elif action == 'retrieve':
-        mirror(remote, local)
-    elif action == 'remove':
-        remove(remote)
-    elif action == 'info':
-        info(remote)
-        ftp.quit()
-        return
+    local = localHandler(pool, localdir)
+    remote = remoteHandler(pool, remotedir)
+    manifest = syncManifest(globals['manifest'], readonly=bool(globals['plan']))
+    if globals['backend'] == 'asyncio':
+        transfers = asyncTransferQueue(globals['jobs'], manifest, pool)
+    else:
+        transfers = transferQueue(globals['jobs'], manifest)
+    if globals['cache_ttl']:
+        globals['cache'] = listingCache(globals['cache_ttl'], globals['cache_persist'] and manifest or None)
+    if globals['events'] or globals['metrics_port']:
+        globals['metrics'] = runMetrics(globals['events'], globals['metrics_port'])
+        event('start', action=action, host=host, remotedir=remotedir, localdir=localdir)
+
+    try:
+        if action == 'store':
+            plan = syncPlan(remote, transfers, manifest, bool(globals['plan']))
+            mirror(local, remote, plan, manifest, resumable(local, remote, manifest))
+        elif action == 'retrieve':
+            plan = syncPlan(local, transfers, manifest, bool(globals['plan']))
+            mirror(remote, local, plan, manifest, resumable(remote, local, manifest))
+        elif action == 'remove':
+            remove(remote, manifest)
+        elif action == 'info':
+            info(remote, manifest)
+            return
+        if globals['plan']:
+            summarize_plan(plan, manifest)
+            return
+        transfers.join()
+        if action != 'remove':
+            plan.finish()
+        manifest.finish(full=not globals['incremental'])
+        status = globals['status']
+        manifest.record(status['bytes_transfered'],
+                        (datetime.datetime.now() - status['time_started']).total_seconds())
+    finally:
+        transfers.shutdown()
+        if globals['removers'] is not None:
+            globals['removers'].shutdown()
+        pool.close()
+        manifest.close()
+        if globals['metrics'] is not None:
+            globals['metrics'].close()
 
-    ftp.quit()
     log('Done')
     status = globals['status']
     status['time_finished'] = datetime.datetime.now()
@@ -449,6 +3567,7 @@ def main():
     print('=' * 60)
     print('%-30s%30s' % ('Directories created', status['dirs_created']))
     print('%-30s%30s' % ('Directories removed', status['dirs_removed']))
+    print('%-30s%30s' % ('Directories skipped', status['dirs_skipped']))
     print('%-30s%30s' % ('Directories total', status['dirs_total']))
     print()
     print()
@@ -459,12 +3578,38 @@ def main():
     print()
     print('%-30s%30s' % ('Bytes transfered', strfbytes(status['bytes_transfered'])))
     print('%-30s%30s' % ('Bytes total', strfbytes(status['bytes_total'])))
+    if globals['filters'] is not None:
+        print('%-30s%30s' % ('Directories excluded', status['dirs_excluded']))
+        print('%-30s%30s' % ('Files excluded', status['files_excluded']))
+        print('%-30s%30s' % ('Bytes excluded', strfbytes(status['bytes_excluded'])))
     print()
     print('%-30s%30s' % ('Time started', status['time_started']))
     print('%-30s%30s' % ('Time finished', status['time_finished']))
-    print('%-30s%30s' % ('Duration', status['time_finished'] - status['time_started']))
+    duration = status['time_finished'] - status['time_started']
+    print('%-30s%30s' % ('Duration', duration))
+    print()
+    seconds = max(duration.total_seconds(), 0.001)
+    print('%-30s%30s' % ('Throughput', strfbytes(status['bytes_transfered'] / seconds) + '/s'))
+    if globals['limiter'] is not None:
+        rate = globals['limiter'].rate()
+        print('%-30s%30s' % ('Rate limit now', rate and strfbytes(rate) + '/s' or 'unlimited'))
+        print('%-30s%30s' % ('Time throttled', datetime.timedelta(seconds=int(status['seconds_throttled']))))
+    for worker in sorted(transfers.stats):
+        stats = transfers.stats[worker]
+        rate = stats['bytes'] / max(stats['seconds'], 0.001)
+        print('%-30s%30s' % ('  %s (%i files)' % (worker, stats['files']), strfbytes(rate) + '/s'))
+    print()
+    if globals['cache'] is not None:
+        cache = globals['cache']
+        print('%-30s%30s' % ('Listing cache hits', '%i of %i' % (cache.hits, cache.hits + cache.misses)))
+    print('%-30s%30s' % ('Retries', status['retries']))
+    print('%-30s%30s' % ('Failures', len(globals['failures'])))
+    for description, error in globals['failures']:
+        print('  %s: %s' % (description, error))
     print('=' * 60)
     print()
+    if globals['failures']:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+#       mirror-jobs.py - Run many ftp-mirror.py profiles from one config
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+
+"""
+Usage: mirror-jobs [-v] [-q] [-c config] [-l lockdir] [-o logdir] [profile ...]
+-v: verbose, also pass -v to the mirror jobs
+-q: quiet
+-c config: profile file (default sync.cfg)
+-l lockdir: directory of the per-profile lock files (default .)
+-o logdir: directory of the per-profile logs (default .)
+profile: run only the given profiles (default all)
+
+The config holds one section per profile with the keys of sync.cfg, a
+sync.cfg without sections is a single profile named default:
+
+    [runner]
+    max_jobs=4              # mirror jobs running at the same time
+    host_connections=8      # connections per host, jobs + scanners of its jobs
+    bandwidth=50M           # budget shared by the jobs running at the time
+
+    [peptideatlas-human]
+    ftp_host=ftp.peptideatlas.org
+    ftp_user=anonymous
+    ftp_password=''
+    dir_remote=/pub/PeptideAtlas/Repository/Human/
+    dir_local=data/human/
+    action=retrieve         # or store
+    priority=10             # higher runs first
+    jobs=5                  # -j, parallel transfers
+    scanners=2              # -w, parallel listings
+    interval=1440           # rerun every N minutes, the runner keeps going
+    options=-i -c md5       # more ftp-mirror.py options
+
+Each profile holds a lock file while it runs, so a profile still running
+from another runner is skipped rather than started twice. The bandwidth
+is split evenly over the jobs running: each job reads its rate from
+<lockdir>/<profile>.rate (ftp-mirror.py -r @file), which the runner
+rewrites whenever a job starts or finishes.
+"""
+
+import sys
+import os
+import getopt
+import time
+import datetime
+import shlex
+import subprocess
+import configparser
+
+globals = {
+    'verbose': 1,
+    'config': 'sync.cfg',
+    'lockdir': '.',
+    'logdir': '.',
+    'mirror': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ftp-mirror.py'),
+}
+
+
+def log(msg, level=1, abort=False):
+    if level <= globals['verbose'] or abort:
+        if abort:
+            sys.stdout = sys.stderr
+            print()
+        print('%s %s' % (time.strftime('%Y-%m-%d %H:%M:%S'), msg))
+        sys.stdout.flush()
+    if abort:
+        sys.exit(1)
+
+
+def strtobytes(value):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+class mirrorJob:
+    """One profile of the config and the ftp-mirror.py process running it"""
+
+    def __init__(self, name, section):
+        self.name = name
+        for key in ('ftp_host', 'dir_remote', 'dir_local'):
+            if not section.get(key):
+                raise ValueError('%s is missing in profile %s' % (key, name))
+        self.host = section['ftp_host']
+        self.user = section.get('ftp_user', '')
+        self.password = section.get('ftp_password', '')
+        self.remote = section['dir_remote']
+        self.local = section['dir_local']
+        self.action = section.get('action', 'retrieve')
+        if self.action not in ('retrieve', 'store'):
+            raise ValueError('Unknown action %s in profile %s' % (self.action, name))
+        self.priority = int(section.get('priority', 0))
+        self.jobs = int(section.get('jobs', 1))
+        self.scanners = int(section.get('scanners', 1))
+        self.segments = int(section.get('segments', 1))
+        self.interval = float(section.get('interval', 0)) * 60
+        self.options = shlex.split(section.get('options', ''))
+        self.due = 0
+        self.process = None
+        self.started = None
+        self.runs = []
+
+    @property
+    def address(self):
+        """Host the connection limit applies to, without transport and port"""
+        return self.host.rpartition('://')[2].partition(':')[0]
+
+    @property
+    def connections(self):
+        return self.jobs * self.segments + self.scanners
+
+    @property
+    def lockfile(self):
+        return os.path.join(globals['lockdir'], '%s.lock' % self.name)
+
+    def lock(self):
+        try:
+            fd = os.open(self.lockfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                pid = int(open(self.lockfile).read().strip() or 0)
+                os.kill(pid, 0)
+                return False
+            except (ValueError, ProcessLookupError):
+                # Left behind by a runner that died, take it over
+                log('Removing stale lock %s' % self.lockfile, 2)
+                os.remove(self.lockfile)
+                return self.lock()
+            except PermissionError:
+                return False
+        os.write(fd, ('%i\n' % os.getpid()).encode())
+        os.close(fd)
+        return True
+
+    def unlock(self):
+        for path in (self.lockfile, self.ratefile):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    @property
+    def ratefile(self):
+        return os.path.join(globals['lockdir'], '%s.rate' % self.name)
+
+    def limit(self, rate):
+        """Hands the job its share of the bandwidth, written to a temporary
+        file first so the job never reads a half-written rate"""
+        temp = '%s.%i' % (self.ratefile, os.getpid())
+        with open(temp, 'w') as fh:
+            fh.write('%i\n' % rate)
+        os.replace(temp, self.ratefile)
+
+    def command(self, rate):
+        command = [sys.executable, globals['mirror'], '-j', str(self.jobs), '-w', str(self.scanners)]
+        if self.segments > 1:
+            command += ['-s', str(self.segments)]
+        if globals['verbose'] > 1:
+            command.append('-v')
+        if rate:
+            command += ['-r', '@' + self.ratefile]
+        if self.user and self.user != 'anonymous':
+            command += ['-u', self.user, '-p', self.password.strip('\'"')]
+        command += self.options
+        command += [self.action, self.host, self.remote, self.local]
+        return command
+
+    def start(self, rate):
+        logfile = open(os.path.join(globals['logdir'], '%s.log' % self.name), 'a')
+        logfile.write('\n%s Starting %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), self.name))
+        logfile.flush()
+        self.process = subprocess.Popen(self.command(rate), stdin=subprocess.DEVNULL,
+                                        stdout=logfile, stderr=subprocess.STDOUT)
+        logfile.close()
+        self.started = time.time()
+
+    def finished(self):
+        if self.process is None or self.process.poll() is None:
+            return False
+        self.runs.append((self.started, time.time(), self.process.returncode))
+        self.process = None
+        return True
+
+
+def load(path):
+    parser = configparser.ConfigParser(inline_comment_prefixes=('#',), interpolation=None)
+    text = open(path).read()
+    if not parser.SECTCRE.search(text):
+        # Plain sync.cfg as used by ftp-mirror.sh
+        text = '[default]\n' + text
+    parser.read_string(text, path)
+    runner = parser['runner'] if parser.has_section('runner') else {}
+    jobs = [mirrorJob(name, parser[name]) for name in parser.sections() if name != 'runner']
+    return runner, jobs
+
+
+def share(running, bandwidth):
+    """Splits the bandwidth evenly over the running jobs. A job already
+    running drops to its new share within a second of a start, so the budget
+    may be exceeded for about that long"""
+    if bandwidth:
+        for job in running:
+            job.limit(max(bandwidth // len(running), 1))
+
+
+def schedule(runner, jobs):
+    max_jobs = int(runner.get('max_jobs', 4))
+    host_connections = int(runner.get('host_connections', 8))
+    bandwidth = strtobytes(runner.get('bandwidth', '0'))
+    pending = list(jobs)
+    running = []
+    used = {}
+    while pending or running:
+        now = time.time()
+        pending.sort(key=lambda job: (-job.priority, job.due))
+        for job in list(pending):
+            if len(running) >= max_jobs:
+                break
+            if job.due > now:
+                continue
+            if used.get(job.address, 0) + job.connections > host_connections and used.get(job.address):
+                # Waits for its host, lower priorities on other hosts go ahead
+                continue
+            pending.remove(job)
+            if not job.lock():
+                log('%s is already running, skipped' % job.name)
+                if job.interval:
+                    job.due = now + job.interval
+                    pending.append(job)
+                continue
+            log('Starting %s (%s %s%s, priority %i)' % (job.name, job.action, job.host, job.remote, job.priority))
+            running.append(job)
+            share(running, bandwidth)
+            job.start(bandwidth)
+            used[job.address] = used.get(job.address, 0) + job.connections
+        time.sleep(1)
+        for job in [job for job in running if job.finished()]:
+            running.remove(job)
+            used[job.address] -= job.connections
+            job.unlock()
+            started, finished, code = job.runs[-1]
+            log('%s %s after %s' % (job.name, code and 'failed (exit %i)' % code or 'finished',
+                                   datetime.timedelta(seconds=int(finished - started))))
+            if job.interval:
+                job.due = started + job.interval
+                pending.append(job)
+            share(running, bandwidth)
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'vqc:l:o:')
+    except getopt.GetoptError as msg:
+        log('%s\n%s' % (msg, __doc__), abort=True)
+    for opt, val in opts:
+        if opt == '-v': globals['verbose'] += 1
+        if opt == '-q': globals['verbose'] = 0
+        if opt == '-c': globals['config'] = val
+        if opt == '-l': globals['lockdir'] = val
+        if opt == '-o': globals['logdir'] = val
+
+    if not os.path.exists(globals['config']):
+        log('%s could not be found.' % globals['config'], abort=True)
+    try:
+        runner, jobs = load(globals['config'])
+    except (ValueError, configparser.Error) as err:
+        log(err, abort=True)
+    if args:
+        unknown = set(args) - set(job.name for job in jobs)
+        if unknown:
+            log('Unknown profiles: %s' % ', '.join(sorted(unknown)), abort=True)
+        jobs = [job for job in jobs if job.name in args]
+
+    try:
+        schedule(runner, jobs)
+    finally:
+        for job in jobs:
+            if job.process is not None:
+                job.process.terminate()
+                job.process.wait()
+                job.unlock()
+
+    print()
+    print('=' * 60)
+    print('Jobs Summary')
+    print('=' * 60)
+    for job in jobs:
+        for started, finished, code in job.runs:
+            print('%-30s%30s' % (job.name, '%s in %s' % (code and 'exit %i' % code or 'ok',
+                                                         datetime.timedelta(seconds=int(finished - started)))))
+    print('=' * 60)
+    print()
+    if any(code for job in jobs for started, finished, code in job.runs):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        log('Aborted', abort=True)
@@ -3,38 +3,278 @@ import re
 import sys
 import time
 import argparse
+import multiprocessing
+from array import array
+import numpy as np
 from pyopenms import *
 from tqdm import tqdm
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Phosphosites with an AScore column in the results
+ASCORE_SITES = 3
+
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
+def build_ascore(params):
+    ascore = AScore()
+    ascore_params = ascore.getParameters()
+    for key, val in params.items():
+        ascore_params.setValue(key, val)
+    ascore.setParameters(ascore_params)
+    return ascore
+
+
+def meta_float(hit, name):
+    return float(hit.getMetaValue(name)) if hit.metaValueExists(name) else float("nan")
+
+
+def summarize_hit(ascore_hit):
+    scores = [meta_float(ascore_hit, "AScore_{}".format(i)) for i in range(1, ASCORE_SITES + 1)]
+    return ascore_hit.getSequence().toBracketString(), meta_float(ascore_hit, "AScore_pep_score"), scores
+
+
+# Each pool worker keeps its own AScore, pyopenms objects cannot be pickled
+worker_ascore = None
+
+
+def init_worker(params):
+    global worker_ascore
+    worker_ascore = build_ascore(params)
+
+
+def score_task(task):
+    """
+    Runs AScore on a pair shipped to a worker as plain values: the hit as
+    (sequence, score, charge) and the spectrum as its (mz, intensity) arrays.
+    """
+    (sequence, score, charge), peaks = task
+    hit = PeptideHit()
+    hit.setSequence(AASequence.fromString(sequence))
+    hit.setScore(score)
+    hit.setCharge(charge)
+    spectrum = MSSpectrum()
+    spectrum.set_peaks(peaks)
+    return summarize_hit(worker_ascore.compute(hit, spectrum))
+
+
+def as_text(value):
+    return value.decode("utf8") if isinstance(value, bytes) else value
+
+
+def is_decoy(hit):
+    """
+    Decoy flag of a hit, from the target_decoy annotation of PeptideIndexer
+    when present, else from "decoy" in any protein accession.
+    """
+    if hit.metaValueExists("target_decoy"):
+        return as_text(hit.getMetaValue("target_decoy")) == "decoy"
+    return any("decoy" in as_text(acc).lower() for acc in hit.extractProteinAccessionsSet())
+
+
+SCAN_PATTERN = re.compile(r"(?:^|\s)scan=(\d+)")
+INDEX_PATTERN = re.compile(r"(?:^|\s)index=(\d+)")
+
+
+def reference_key(reference):
+    """
+    Index key of an identification's spectrum_reference: ("scan", n) for
+    scan= references and bare numbers, ("index", n) for 0-based index=
+    references and ("native", id) for any other native ID.
+    """
+    reference = as_text(reference)
+    match = SCAN_PATTERN.search(reference)
+    if match:
+        return "scan", int(match.group(1))
+    match = INDEX_PATTERN.search(reference)
+    if match:
+        return "index", int(match.group(1))
+    if reference.strip().isdigit():
+        return "scan", int(reference)
+    return "native", reference
+
+
+def spectrum_keys(native_id, position):
+    """
+    Index keys of the spectrum at 0-based `position`. Native IDs without a
+    scan number get position + 1, the scan number OpenMS would report.
+    """
+    native_id = as_text(native_id)
+    match = SCAN_PATTERN.search(native_id)
+    scan = int(match.group(1)) if match else position + 1
+    return ("scan", scan), ("index", position), ("native", native_id)
+
+
+def is_indexed_mzml(path, tail=4096):
+    """
+    Whether the mzML at path ends with an index, judged from its last bytes
+    so that a file without one is not parsed just to find out.
+    """
+    with open(path, "rb") as fh:
+        fh.seek(0, 2)
+        fh.seek(max(0, fh.tell() - tail))
+        return b"<indexListOffset>" in fh.read()
+
+
+class OnDiscSpectra:
+    def __init__(self, exp, keys):
+        """
+        Scan index of an indexed mzML whose MS2 spectra are read from disk
+        when looked up. Only the positions of spectra matching `keys` are kept.
+        """
+        self.exp = exp
+        self.positions = {}
+        meta = exp.getMetaData()
+        for position in range(meta.getNrSpectra()):
+            spec = meta.getSpectrum(position)
+            if spec.getMSLevel() == 2:
+                for key in spectrum_keys(spec.getNativeID(), position):
+                    if key in keys:
+                        self.positions[key] = position
+
+    def get(self, key):
+        position = self.positions.get(key)
+        if position is None:
+            return None
+        spec = self.exp.getSpectrum(position)
+        spec.setMetaValue("index", position + 1)
+        return spec
+
+
+class MS2Consumer:
+    def __init__(self, keys):
+        """
+        Consumer for MzMLFile().transform that indexes the MS2 spectra
+        matching `keys` and drops everything else while the file streams by.
+        """
+        self.keys = keys
+        self.position = 0
+        self.spectra = {}
+
+    def setExpectedSize(self, nspectra, nchromatograms):
+        pass
+
+    def setExperimentalSettings(self, settings):
+        pass
+
+    def consumeSpectrum(self, spec):
+        if spec.getMSLevel() == 2:
+            for key in spectrum_keys(spec.getNativeID(), self.position):
+                if key in self.keys:
+                    spec.setMetaValue("index", self.position + 1)
+                    self.spectra[key] = spec
+        self.position += 1
+
+    def consumeChromatogram(self, chromatogram):
+        pass
+
+
+class ResultColumns:
+    names = ["Scan", "Peptide", "NPhospho", "PepScore"] + ["AScore_{}".format(i) for i in range(1, ASCORE_SITES + 1)]
+
+    def __init__(self, out_file, chunk_size=10000):
+        """
+        Typed column buffers for AScore results, written to out_file every
+        chunk_size rows: Parquet for .parquet, Arrow IPC for .arrow and
+        .feather (both need pyarrow) and TSV otherwise.
+        """
+        self.out_file = out_file
+        self.chunk_size = chunk_size
+        if out_file.endswith(".parquet"):
+            self.format = "parquet"
+        elif out_file.endswith((".arrow", ".feather")):
+            self.format = "arrow"
+        else:
+            self.format = "tsv"
+        if self.format != "tsv" and pa is None:
+            raise ImportError("pyarrow is needed to write {}".format(out_file))
+        self.written = 0
+        self.writer = None
+        self.clear()
+
+    def clear(self):
+        self.scan = array("q")
+        self.sequence = []
+        self.n_phospho = array("i")
+        self.pep_score = array("d")
+        self.site_scores = [array("d") for _ in range(ASCORE_SITES)]
+
+    def __len__(self):
+        return self.written + len(self.scan)
+
+    def append(self, scan, sequence, n_phospho, pep_score, scores):
+        self.scan.append(scan)
+        self.sequence.append(sequence)
+        self.n_phospho.append(n_phospho)
+        self.pep_score.append(pep_score)
+        for column, score in zip(self.site_scores, scores):
+            column.append(score)
+        if len(self.scan) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.writer is None:
+            self.open()
+        if self.format == "tsv":
+            for row in zip(self.scan, self.sequence, self.n_phospho, self.pep_score, *self.site_scores):
+                self.writer.write("\t".join("" if e != e else str(e) for e in row))
+                self.writer.write("\n")
+        else:
+            columns = [np.frombuffer(self.scan, dtype=np.int64), self.sequence,
+                       np.frombuffer(self.n_phospho, dtype=np.int32), np.frombuffer(self.pep_score, dtype=np.float64)]
+            columns += [np.frombuffer(column, dtype=np.float64) for column in self.site_scores]
+            self.writer.write_table(pa.Table.from_arrays([pa.array(c) for c in columns], schema=self.schema))
+        self.written += len(self.scan)
+        self.clear()
+
+    def open(self):
+        if self.format == "tsv":
+            self.writer = open(self.out_file, "w")
+            self.writer.write("\t".join(self.names))
+            self.writer.write("\n")
+            return
+        self.schema = pa.schema([("Scan", pa.int64()), ("Peptide", pa.string()), ("NPhospho", pa.int32()),
+                                 ("PepScore", pa.float64())] + [(name, pa.float64()) for name in self.names[4:]])
+        if self.format == "parquet":
+            self.writer = pq.ParquetWriter(self.out_file, self.schema)
+        else:
+            self.writer = pa.ipc.new_file(self.out_file, self.schema)
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
 class AscoreAnalyzer:
     def __init__(self, spec_file, ident_file, out_file, hit_depth=1, target_fdr=1., n_to_profile=0,
-                 profile_file_name="profile.tsv", **kwargs):
+                 profile_file_name="profile.tsv", workers=1, low_memory=False, chunk_size=10000, **kwargs):
         """
         AscoreAnalyzer provides a wrapper to load Spectra from MzML files
         and peptide identifications from Comet from pepXML files. It then
-        zips them together, and matches hits to spectra based on retention
-        time and M/Z (guessing must occur since OpenMS does not retain scan
-        information when loading identifications). This class then handles
-        Ascore and allows printing TSVs.
+        zips them together, and matches hits to spectra through an index
+        of scan numbers, spectrum indices and native IDs built at load time.
+        This class then handles Ascore and writes its results in chunks
+        as TSV, Parquet or Arrow.
+
+        With low_memory, only the MS2 spectra referenced by identifications
+        are kept: indexed mzML files are read from disk as spectra are
+        needed, others are streamed once.
         """
 
         # Result properties
         self.out_file = out_file
-        self.results = []
-
-        # Load spectra
-        exp = MSExperiment()
-        MzMLFile().load(spec_file, exp)
-        self.spectra = exp.getSpectra()
-        # OpenMS does not retain scan indices, so we inject them here.
-        [spec.setMetaValue("index", ind + 1) for ind, spec in enumerate(self.spectra)]
-        self.spectra = [spec for spec in self.spectra if spec.getMSLevel() == 2]
-        self.spectra.sort(key=lambda spec: spec.getRT())
+        self.results = ResultColumns(out_file, chunk_size)
+        self.target_fdr = target_fdr
+        self.score_threshold = None
+        self.higher_score_better = False
+        self.decoys = None
 
         # Load identifications
         eprint(
@@ -54,12 +294,36 @@ class AscoreAnalyzer:
         IdXMLFile().load(ident_file, self.protein_records, self.peptide_records)
         self.peptide_records.sort(key=lambda pep: pep.getRT())
 
+        # Load spectra into an index by scan number, 0-based index and native ID
+        self.unmatched = []
+        if low_memory:
+            self.spectra = self.load_referenced_spectra(spec_file)
+        else:
+            exp = MSExperiment()
+            MzMLFile().load(spec_file, exp)
+            self.spectra = {}
+            for position, spec in enumerate(exp.getSpectra()):
+                if spec.getMSLevel() == 2:
+                    # OpenMS does not retain scan indices, so we inject them here.
+                    spec.setMetaValue("index", position + 1)
+                    for key in spectrum_keys(spec.getNativeID(), position):
+                        self.spectra[key] = spec
+
         # AScore Init
-        self.ascore = AScore()
-        ascore_params = self.ascore.getParameters()
-        for key, val in kwargs.items():
-            ascore_params.setValue(key, val)
-        self.ascore.setParameters(ascore_params)
+        self.workers = workers
+        self.ascore_params = kwargs
+        self.ascore = build_ascore(kwargs)
+
+    def load_referenced_spectra(self, spec_file):
+        keys = set(reference_key(record.getMetaValue("spectrum_reference")) for record in self.peptide_records)
+        if is_indexed_mzml(spec_file):
+            exp = OnDiscMSExperiment()
+            if exp.openFile(spec_file):
+                return OnDiscSpectra(exp, keys)
+        eprint("--> {} has no index, streaming it instead".format(spec_file))
+        consumer = MS2Consumer(keys)
+        MzMLFile().transform(spec_file, consumer)
+        return consumer.spectra
 
     def generate_hits(self, record):
         nsupplied = 0
@@ -75,67 +339,97 @@ class AscoreAnalyzer:
                 break
 
     def generate_pairs(self):
-        spec_ind = 0
-        record_ind = 0
-        while spec_ind < len(self.spectra) and record_ind < len(self.peptide_records):
-
-            # Extract scan number from respective elements
-            spec_scan = self.spectra[spec_ind].getMetaValue("index")
-            record_scan = int(
-                re.search("(?<=scan\=)[0-9]+",
-                          self.peptide_records[record_ind].getMetaValue('spectrum_reference')).group()
-            )
-            # print(spec_scan, record_scan)
-            if spec_scan == record_scan:
-                for hit in self.generate_hits(self.peptide_records[record_ind]):
-                    yield self.spectra[spec_ind], hit
-                spec_ind += 1
-                record_ind += 1
-
-            elif record_scan > spec_scan:
-                spec_ind += 1
-
-            else:
-                record_ind += 1
+        self.unmatched = []
+        for nrecord, record in enumerate(self.peptide_records):
+            reference = as_text(record.getMetaValue("spectrum_reference"))
+            spectrum = self.spectra.get(reference_key(reference))
+            if spectrum is None:
+                self.unmatched.append(reference)
+                continue
+            for nhit, hit in enumerate(self.generate_hits(record)):
+                decoy = self.decoys is not None and self.decoys[nrecord][nhit]
+                if self.passes_score_threshold(hit, decoy):
+                    yield spectrum, hit
+
+        if self.unmatched:
+            eprint("--> {} of {} identifications matched no MS2 spectrum, e.g. {}".format(
+                len(self.unmatched), len(self.peptide_records), ", ".join(self.unmatched[:5])))
 
     def calculate_score_threshold(self):
-        hit_array = np.concatenate([[h for h in self.generate_hits(r)] for r in self.peptide_records])
-        scores = np.array([h.getScore() for h in hit_array])
-        labels = np.array([
-            any(["decoy".encode("utf8") in acc for acc in h.extractProteinAccessionsSet()]) for h in hit_array
-        ]).astype(float)
+        """
+        Sets score_threshold to the worst score whose q-value is within
+        target_fdr, estimating the FDR of the best n hits as (decoys + 1) / n.
+        The decoy flags are kept per record and hit for generate_pairs.
+        """
+        record_hits = [[(hit.getScore(), is_decoy(hit)) for hit in self.generate_hits(record)]
+                       for record in self.peptide_records]
+        self.decoys = [[decoy for score, decoy in hits] for hits in record_hits]
+        hits = [hit for hits in record_hits for hit in hits]
+        scores = np.fromiter((score for score, decoy in hits), dtype=float, count=len(hits))
+        labels = np.fromiter((decoy for score, decoy in hits), dtype=float, count=len(hits))
 
-        sorted_ind = np.argsort(scores)
+        self.higher_score_better = bool(self.peptide_records) and self.peptide_records[0].isHigherScoreBetter()
+        sorted_ind = np.argsort(-scores if self.higher_score_better else scores, kind="stable")
         scores = scores[sorted_ind]
         labels = labels[sorted_ind]
 
-        fpr = (np.cumsum(labels) + 1) / np.arange(1, len(labels) + 1)
-        for ind in np.arange(0, len(labels) - 1)[::-1]:
-            fpr[ind] = min(fpr[ind], fpr[ind + 1])
+        fdr = (np.cumsum(labels) + 1) / np.arange(1, len(labels) + 1)
+        qvalues = np.minimum.accumulate(fdr[::-1])[::-1]
+        npassing = np.searchsorted(qvalues, self.target_fdr, side="right")
 
-        self.score_threshold = scores[min(len(fpr) - 1, np.searchsorted(fpr, self.target_fdr))]
+        if npassing:
+            self.score_threshold = scores[npassing - 1]
+        else:
+            self.score_threshold = np.inf if self.higher_score_better else -np.inf
+        eprint("--> {} of {} hits pass {:g} FDR at score threshold {:g}, {} of them decoys".format(
+            npassing, len(scores), self.target_fdr, self.score_threshold, int(labels[:npassing].sum())))
 
-    # def passes_score_threshold(self, match):
-    #     return match.getScore() < self.score_threshold
+    def passes_score_threshold(self, hit, decoy=False):
+        if self.score_threshold is None:
+            return True
+        if decoy:
+            return False
+        if self.higher_score_better:
+            return hit.getScore() >= self.score_threshold
+        return hit.getScore() <= self.score_threshold
 
-    def analyze(self):
-        for spectrum, hit in tqdm(self.generate_pairs()):
+    def generate_phospho_pairs(self):
+        for spectrum, hit in self.generate_pairs():
             nphospho = hit.getSequence().toString().count("Phospho")
             if nphospho > 0:
-                ascore_hit = self.ascore.compute(hit, spectrum)
-                scores = [str(ascore_hit.getMetaValue("AScore_{}".format(i))) for i in range(1, 3 + 1)]
-                self.results.append((spectrum.getMetaValue("index"),
-                                     ascore_hit.getSequence().toBracketString(),
-                                     nphospho, ascore_hit.getMetaValue("AScore_pep_score"),
-                                     ";".join(scores)))
-
-    def to_tsv(self):
-        with open(self.out_file, "w") as dest:
-            dest.write("\t".join(["Scan", "Peptide", "NPhospho", "PepScore", "Ascores"]))
-            dest.write("\n")
-            for res in self.results:
-                dest.write("\t".join([str(e) for e in res]))
-                dest.write("\n")
+                yield spectrum, hit, nphospho
+
+    def analyze(self):
+        if self.target_fdr < 1:
+            self.calculate_score_threshold()
+        if self.workers > 1:
+            return self.analyze_parallel()
+        for spectrum, hit, nphospho in tqdm(self.generate_phospho_pairs()):
+            sequence, pep_score, scores = summarize_hit(self.ascore.compute(hit, spectrum))
+            self.results.append(spectrum.getMetaValue("index"), sequence, nphospho, pep_score, scores)
+
+    def analyze_parallel(self, chunksize=64):
+        """
+        Same results as the serial analyze, with the pairs sharded across a
+        process pool. imap hands results back in submission order, so the
+        output does not depend on which worker finished first.
+        """
+        keys = []
+
+        def tasks():
+            for spectrum, hit, nphospho in self.generate_phospho_pairs():
+                keys.append((spectrum.getMetaValue("index"), nphospho))
+                yield ((hit.getSequence().toString(), hit.getScore(), hit.getCharge()),
+                       spectrum.get_peaks())
+
+        with multiprocessing.Pool(self.workers, init_worker, (self.ascore_params,)) as pool:
+            for ind, (sequence, pep_score, scores) in enumerate(tqdm(pool.imap(score_task, tasks(), chunksize))):
+                scan, nphospho = keys[ind]
+                self.results.append(scan, sequence, nphospho, pep_score, scores)
+
+    def write_results(self):
+        """Writes the rows still buffered and closes out_file"""
+        self.results.close()
 
 
 if __name__ == "__main__":
@@ -151,12 +445,24 @@ if __name__ == "__main__":
                              "peaks. In Da.")
     parser.add_argument("--max_peptide_length", default=50, type=int,
                         help="Maximum length peptide hit to consider.")
+    parser.add_argument("--target_fdr", default=1., type=float,
+                        help="Only analyze hits within this target-decoy FDR. "
+                             "1 keeps every hit.")
+    parser.add_argument("--workers", default=1, type=int,
+                        help="Number of processes computing Ascores. Output order "
+                             "is the same as with a single process.")
+    parser.add_argument("--low_memory", action="store_true",
+                        help="Keep only the MS2 spectra referenced by identifications, "
+                             "reading indexed mzML from disk as needed.")
+    parser.add_argument("--chunk_size", default=10000, type=int,
+                        help="Results buffered before they are written out.")
     parser.add_argument("spec_file", type=str,
                         help="MS Spectra file supplied as MZML")
     parser.add_argument("ident_file", type=str,
                         help="idXML hits supplied as pepXML")
     parser.add_argument("out_file", type=str,
-                        help="Destination for ascores")
+                        help="Destination for ascores, Parquet or Arrow (needs pyarrow) "
+                             "when ending in .parquet, .arrow or .feather, TSV otherwise")
     args = vars(parser.parse_args())
 
     # Algorithm script
@@ -172,6 +478,6 @@ if __name__ == "__main__":
     eprint("--> Ascore calculations complete on: {}".format(time.ctime()))
 
     eprint("--> Writing output...")
-    analyzer.to_tsv()
+    analyzer.write_results()
     eprint("--> OpenMS-Ascore Wrapper completed on: {}".format(time.ctime()))
     eprint("--> Total runtime: {:.1f} seconds".format(time.time() - run_start))
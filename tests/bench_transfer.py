@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+#       bench_transfer.py - Throughput and CPU cost of ftp-mirror.py transfers
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+
+"""
+Usage: bench_transfer [-n runs] [-s size] [-d dir] [-- ftp-mirror option ...]
+-n runs: runs per action, the best one is reported (default 3)
+-s size: size of the transferred file (default 1G)
+-d dir: scratch directory, needs room for three copies (default system temp)
+ftp-mirror option: passed to every run, e.g. -- -B 64K -b asyncio
+
+Starts a pyftpdlib server on a free local port, then times ftp-mirror.py
+retrieving one file from it and storing it back. The client CPU is the
+user + system time of the ftp-mirror.py process from getrusage, the server
+runs in this process and is not counted. Wall-clock rates are capped by the
+single-threaded Python server, CPU s/GB is the figure to compare. Needs
+the packages of requirements-test.txt.
+"""
+
+import sys
+import os
+import getopt
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import resource
+import logging
+
+import pytest
+
+pytest.importorskip('pyftpdlib')
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import FTPServer
+
+MIRROR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ftp-mirror.py')
+
+
+def strtobytes(value):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def serve(root):
+    # Keep the per-command log of pyftpdlib out of the report
+    logging.getLogger('pyftpdlib').addHandler(logging.NullHandler())
+    logging.getLogger('pyftpdlib').setLevel(logging.WARNING)
+    authorizer = DummyAuthorizer()
+    authorizer.add_user('bench', 'bench', root, perm='elradfmwMT')
+    handler = type('handler', (FTPHandler,), {'authorizer': authorizer})
+    server = FTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, kwargs={'timeout': 0.1}, daemon=True)
+    thread.start()
+    return server, thread
+
+
+def makefile(path, size):
+    block = os.urandom(1024 ** 2)
+    with open(path, 'wb') as fh:
+        while size > 0:
+            fh.write(block[:size])
+            size -= len(block)
+
+
+def clean(path):
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+def run(command):
+    """Wall-clock and CPU seconds of one ftp-mirror.py run"""
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, check=True)
+    wall = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return wall, after.ru_utime - before.ru_utime + after.ru_stime - before.ru_stime
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'n:s:d:')
+    except getopt.GetoptError as msg:
+        print('%s\n%s' % (msg, __doc__), file=sys.stderr)
+        sys.exit(1)
+    runs, size, scratch = 3, 1024 ** 3, None
+    for opt, val in opts:
+        if opt == '-n': runs = int(val)
+        if opt == '-s': size = strtobytes(val)
+        if opt == '-d': scratch = val
+
+    work = tempfile.mkdtemp(prefix='bench-', dir=scratch)
+    root = os.path.join(work, 'ftproot')
+    local = os.path.join(work, 'local')
+    source = os.path.join(work, 'source')
+    for path in (os.path.join(root, 'pub'), source):
+        os.makedirs(path)
+    makefile(os.path.join(root, 'pub', 'big.bin'), size)
+    os.link(os.path.join(root, 'pub', 'big.bin'), os.path.join(source, 'big.bin'))
+    server, thread = serve(root)
+    host = '127.0.0.1:%i' % server.address[1]
+    manifest = os.path.join(work, 'manifest.db')
+    command = [sys.executable, MIRROR, '-q', '-m', manifest, '-u', 'bench', '-p', 'bench'] + args
+
+    results = []
+    try:
+        for action, remote, target in (('retrieve', '/pub', local), ('store', '/upload', source)):
+            best = None
+            for i in range(runs):
+                if os.path.exists(manifest):
+                    os.remove(manifest)
+                clean(local)
+                clean(os.path.join(root, 'upload'))
+                wall, cpu = run(command + [action, host, remote, target])
+                if best is None or wall < best[0]:
+                    best = (wall, cpu)
+            results.append((action, best))
+    finally:
+        server.close_all()
+        thread.join(5)
+        shutil.rmtree(work, ignore_errors=True)
+
+    print()
+    print('=' * 60)
+    print('Transfer Benchmark (%.0f MB, best of %i)' % (size / 1e6, runs))
+    print('=' * 60)
+    for action, (wall, cpu) in results:
+        print('%-30s%30s' % (action, '%.0f MB/s, %.2f CPU s/GB' % (size / 1e6 / wall, cpu / (size / 1e9))))
+    print('=' * 60)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+A local pyftpdlib server on a free port for the integration tests, counting
+the sessions and downloads the tests make against it.
+"""
+
+import collections
+import os
+import subprocess
+import sys
+import threading
+import types
+
+import pytest
+
+MIRROR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ftp-mirror.py")
+
+
+@pytest.fixture
+def server(tmp_path):
+    pytest.importorskip("pyftpdlib")
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+
+    root = tmp_path / "ftproot"
+    root.mkdir()
+    authorizer = DummyAuthorizer()
+    authorizer.add_user("user", "secret", str(root), perm="elradfmwMT")
+    stats = types.SimpleNamespace(logins=0, active=0, max_active=0, sent=collections.Counter())
+    lock = threading.Lock()
+
+    class handler(FTPHandler):
+        def on_login(self, username):
+            with lock:
+                stats.logins += 1
+                stats.active += 1
+                stats.max_active = max(stats.max_active, stats.active)
+            self.counted = True
+
+        def on_disconnect(self):
+            if getattr(self, "counted", False):
+                with lock:
+                    stats.active -= 1
+
+        def on_file_sent(self, file):
+            with lock:
+                stats.sent[os.path.relpath(file, str(root))] += 1
+
+    handler.authorizer = authorizer
+    ftpd = ThreadedFTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=ftpd.serve_forever, kwargs={"timeout": 0.1}, daemon=True)
+    thread.start()
+    stats.root = root
+    stats.host = "127.0.0.1:%i" % ftpd.address[1]
+    yield stats
+    ftpd.close_all()
+    thread.join(5)
+
+
+def run_mirror(tmp_path, *args):
+    """One ftp-mirror.py run as user, with a manifest in tmp_path"""
+    command = [sys.executable, MIRROR, "-m", str(tmp_path / "manifest.db"),
+               "-u", "user", "-p", "secret"] + list(args)
+    result = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, universal_newlines=True, timeout=120)
+    assert result.returncode == 0, result.stdout
+    assert "Traceback" not in result.stdout, result.stdout
+    return result.stdout
+
+
+def summary(output, name):
+    """The value of a row of the processing summary"""
+    for line in output.splitlines():
+        if line.startswith(name) and line[:30].strip() == name:
+            return line[30:].strip()
+    raise KeyError(name)
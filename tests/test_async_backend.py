@@ -0,0 +1,115 @@
+"""
+Integration tests of ftp-mirror.py's asyncio backend (-b asyncio) against
+a local pyftpdlib server on a free port.
+"""
+
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("pyftpdlib")
+from conftest import run_mirror
+from test_ftp_mirror import load_mirror
+
+
+def mirror(tmp_path, *args):
+    return run_mirror(tmp_path, "-q", "-b", "asyncio", *args)
+
+
+def make_tree(root):
+    (root / "sub" / "deeper").mkdir(parents=True)
+    (root / "small.txt").write_text("hello\n")
+    (root / "sub" / "data.bin").write_bytes(os.urandom(300000))
+    (root / "sub" / "deeper" / "big.bin").write_bytes(os.urandom(3 * 1024 ** 2 + 17))
+
+
+def assert_same_tree(left, right):
+    names = sorted(str(path.relative_to(left)) for path in left.rglob("*"))
+    assert names == sorted(str(path.relative_to(right)) for path in right.rglob("*"))
+    for name in names:
+        if (left / name).is_file():
+            assert (left / name).read_bytes() == (right / name).read_bytes(), name
+
+
+def test_retrieve(server, tmp_path):
+    root, host = server.root, server.host
+    (root / "pub").mkdir()
+    make_tree(root / "pub")
+    local = tmp_path / "local"
+    local.mkdir()
+    mirror(tmp_path, "retrieve", host, "/pub", str(local))
+    assert_same_tree(root / "pub", local)
+
+    # A second run has nothing to do
+    output = mirror(tmp_path, "retrieve", host, "/pub", str(local))
+    assert '%-30s%30s' % ('Files created', 0) in output
+
+
+def test_retrieve_segments(server, tmp_path):
+    root, host = server.root, server.host
+    (root / "pub").mkdir()
+    make_tree(root / "pub")
+    local = tmp_path / "local"
+    local.mkdir()
+    mirror(tmp_path, "-j", "2", "-s", "4", "-S", "1M", "-c", "md5", "retrieve", host, "/pub", str(local))
+    assert_same_tree(root / "pub", local)
+
+
+def test_store(server, tmp_path):
+    root, host = server.root, server.host
+    (root / "upload").mkdir()
+    local = tmp_path / "local"
+    local.mkdir()
+    make_tree(local)
+    mirror(tmp_path, "-j", "3", "store", host, "/upload", str(local))
+    assert_same_tree(local, root / "upload")
+
+    # Pruned entries are removed from the server
+    (local / "small.txt").unlink()
+    (local / "sub" / "deeper" / "big.bin").unlink()
+    (local / "sub" / "deeper").rmdir()
+    mirror(tmp_path, "store", host, "/upload", str(local))
+    assert_same_tree(local, root / "upload")
+
+
+def test_remove(server, tmp_path):
+    root, host = server.root, server.host
+    (root / "old").mkdir()
+    make_tree(root / "old")
+    mirror(tmp_path, "remove", host, "/old")
+    assert not (root / "old").exists()
+
+
+def test_transfers_are_coroutines(server, tmp_path, monkeypatch):
+    (server.root / "pub").mkdir()
+    for i in range(32):
+        (server.root / "pub" / ("f%02i" % i)).write_bytes(os.urandom(2 * 1024 ** 2))
+    local = tmp_path / "local"
+    local.mkdir()
+    sfm = load_mirror()
+    monkeypatch.setattr(sys, "argv", ["ftp-mirror.py", "-q", "-b", "asyncio", "-j", "16", "-r", "64M",
+                                      "-m", str(tmp_path / "manifest.db"), "-u", "user", "-p", "secret",
+                                      "retrieve", server.host, "/pub", str(local)])
+    names = set()
+    running = threading.Event()
+    running.set()
+
+    def sample():
+        while running.is_set():
+            names.update(thread.name for thread in threading.enumerate())
+            time.sleep(0.01)
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    try:
+        sfm.main()
+    finally:
+        running.clear()
+        sampler.join()
+    assert_same_tree(server.root / "pub", local)
+    assert not [name for name in names if name.startswith(("transfer", "segment"))], names
+    # All 16 transfers had a session open at the same time
+    assert server.max_active >= 16
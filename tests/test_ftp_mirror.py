@@ -0,0 +1,170 @@
+"""
+Tests of ftp-mirror.py: units loaded from the script, mirror runs against
+a local pyftpdlib server on a free port.
+"""
+
+import importlib.util
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+
+from conftest import run_mirror, summary
+
+MIRROR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ftp-mirror.py")
+
+
+def load_mirror():
+    """A fresh copy of the ftp-mirror.py module, with its own globals"""
+    spec = importlib.util.spec_from_file_location("ftp_mirror", MIRROR)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_metrics_exposition():
+    sfm = load_mirror()
+    metrics = sfm.runMetrics()
+    try:
+        metrics.observe("LIST", 0.5)
+        metrics.observe("LIST", 0.25)
+        metrics.observe("RETR", 1.5, 100)
+        text = metrics.prometheus()
+    finally:
+        metrics.close()
+    types = dict(line.split()[2:] for line in text.splitlines() if line.startswith("# TYPE "))
+    assert types == {"sfm_operation_seconds": "summary", "sfm_operation_seconds_max": "gauge"}
+    # A summary only has _count and _sum series (no quantiles here)
+    names = set(line.split("{")[0] for line in text.splitlines() if line.startswith("sfm_operation_seconds"))
+    assert names == {"sfm_operation_seconds_count", "sfm_operation_seconds_sum", "sfm_operation_seconds_max"}
+    assert 'sfm_operation_seconds_max{operation="LIST",connection="MainThread"} 0.500000' in text
+    assert 'sfm_operation_seconds_sum{operation="LIST",connection="MainThread"} 0.750000' in text
+
+
+def test_rate_file_reload(tmp_path):
+    sfm = load_mirror()
+    path = tmp_path / "job.rate"
+    path.write_text("2M\n")
+    limiter = sfm.rateLimiter("@%s" % path)
+    assert limiter.rate() == 2 * 1024 ** 2
+    path.write_text("512K\n")
+    os.utime(path, ns=(0, 10 ** 9))
+    # Changes are looked for at most once a second
+    assert limiter.rate() == 2 * 1024 ** 2
+    limiter.checked -= 1
+    assert limiter.rate() == 512 * 1024
+    # A file that went away keeps the last rate
+    path.unlink()
+    limiter.checked -= 1
+    assert limiter.rate() == 512 * 1024
+
+
+def test_prune_reuses_connections(server, tmp_path):
+    (server.root / "upload").mkdir()
+    local = tmp_path / "local"
+    for i in range(30):
+        (local / ("d%02i" % i) / "sub").mkdir(parents=True)
+        (local / ("d%02i" % i) / "sub" / "f").write_text("x")
+    run_mirror(tmp_path, "-q", "-j", "4", "store", server.host, "/upload", str(local))
+    assert len(os.listdir(server.root / "upload")) == 30
+
+    for i in range(30):
+        (local / ("d%02i" % i) / "sub" / "f").unlink()
+        (local / ("d%02i" % i) / "sub").rmdir()
+        (local / ("d%02i" % i)).rmdir()
+    logins = server.logins
+    run_mirror(tmp_path, "-q", "-j", "4", "-w", "2", "store", server.host, "/upload", str(local))
+    assert os.listdir(server.root / "upload") == []
+    # Removal threads are shared by the whole run, not started per directory
+    assert server.logins - logins <= 4 + 2 + 1
+
+
+def test_rename_deletion_defers_files(server, tmp_path):
+    (server.root / "upload").mkdir()
+    local = tmp_path / "local"
+    (local / "dir").mkdir(parents=True)
+    (local / "dir" / "f").write_text("x")
+    (local / "g").write_text("y")
+    run_mirror(tmp_path, "-q", "-D", "rename", "store", server.host, "/upload", str(local))
+
+    (local / "dir" / "f").unlink()
+    (local / "dir").rmdir()
+    (local / "g").unlink()
+    output = run_mirror(tmp_path, "-v", "-v", "store", server.host, "/upload", str(local))
+    assert "Rename /upload/g to /upload/g.sfm-deleted" in output
+    assert "Rename /upload/dir to /upload/dir.sfm-deleted" in output
+    assert os.listdir(server.root / "upload") == []
+
+
+def finished_files(manifest):
+    """Names of the files the manifest records as transferred"""
+    try:
+        db = sqlite3.connect(str(manifest))
+        try:
+            return set(row[0] for row in db.execute("SELECT name FROM files WHERE mtime > 0"))
+        finally:
+            db.close()
+    except sqlite3.Error:
+        return set()
+
+
+def test_resume_after_interrupt(server, tmp_path):
+    (server.root / "pub" / "c").mkdir(parents=True)
+    for i in range(4):
+        (server.root / "pub" / "c" / ("f%i" % i)).write_bytes(os.urandom(400 * 1024))
+    local = tmp_path / "local"
+    local.mkdir()
+    manifest = tmp_path / "manifest.db"
+    process = subprocess.Popen([sys.executable, MIRROR, "-q", "-m", str(manifest), "-u", "user", "-p", "secret",
+                                "-j", "1", "-r", "400K", "retrieve", server.host, "/pub", str(local)],
+                               stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.time() + 60
+        while len(finished_files(manifest)) < 2 and process.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+    finally:
+        process.kill()
+        process.wait()
+    finished = finished_files(manifest)
+    assert len(finished) >= 2 and len(finished) < 4
+
+    run_mirror(tmp_path, "-q", "--resume", "-j", "2", "retrieve", server.host, "/pub", str(local))
+    # The directory created by the interrupted run is listed, finished files are kept
+    for name in finished:
+        assert server.sent["pub/c/" + name] == 1, name
+    for i in range(4):
+        name = "f%i" % i
+        assert (local / "c" / name).read_bytes() == (server.root / "pub" / "c" / name).read_bytes()
+
+    output = run_mirror(tmp_path, "-q", "retrieve", server.host, "/pub", str(local))
+    assert summary(output, "Files created") == "0"
+    assert summary(output, "Files updated") == "0"
+
+
+def test_incremental_restores_missing_directory(server, tmp_path):
+    (server.root / "pub" / "b").mkdir(parents=True)
+    (server.root / "pub" / "b" / "f").write_text("b\n")
+    local = tmp_path / "local"
+    local.mkdir()
+    run_mirror(tmp_path, "-q", "-i", "retrieve", server.host, "/pub", str(local))
+
+    (local / "b" / "f").unlink()
+    (local / "b").rmdir()
+    output = run_mirror(tmp_path, "-q", "-i", "retrieve", server.host, "/pub", str(local))
+    assert (local / "b" / "f").read_text() == "b\n"
+    assert summary(output, "Directories skipped") == "0"
+
+
+def test_incremental_sees_deeper_changes(server, tmp_path):
+    (server.root / "pub" / "a" / "x").mkdir(parents=True)
+    (server.root / "pub" / "a" / "f").write_text("a\n")
+    local = tmp_path / "local"
+    local.mkdir()
+    run_mirror(tmp_path, "-q", "-i", "retrieve", server.host, "/pub", str(local))
+
+    # Only the mtime of a/x changes, a itself looks unchanged
+    (server.root / "pub" / "a" / "x" / "g").write_text("g\n")
+    output = run_mirror(tmp_path, "-q", "-i", "retrieve", server.host, "/pub", str(local))
+    assert (local / "a" / "x" / "g").read_text() == "g\n"
+    assert int(summary(output, "Directories skipped")) >= 1